@@ -0,0 +1,115 @@
+"""
+Benchmarks layer assignment in Browser.composite from Chapter 13 on
+synthetic display lists with thousands of commands and hundreds of
+composited layers, comparing the grid-indexed version against the
+original loop over every layer that re-joins each layer's bounds.
+Run with: python3 benchmark13.py
+"""
+
+import random
+import time
+import skia
+import wbetools
+from lab13 import Browser, CompositedLayer, Blend, Transform, DrawRect, \
+    PaintCommand, add_parent_pointers, local_to_absolute, tree_to_list
+
+SIZES = [500, 1000, 2000, 4000]
+ROW_HEIGHT = 20
+COMMANDS_PER_ROW = 4
+COMPOSITED_EVERY = 10
+REPEATS = 3
+
+class LegacyCompositedLayer(CompositedLayer):
+    def absolute_bounds(self):
+        rect = skia.Rect.MakeEmpty()
+        for item in self.display_items:
+            rect.join(local_to_absolute(item, item.rect))
+        return rect
+
+class BenchmarkBrowser:
+    def __init__(self, display_list):
+        self.skia_context = None
+        self.active_tab_display_list = display_list
+        self.composited_layers = []
+
+    def composite(self):
+        Browser.composite(self)
+
+    def legacy_composite(self):
+        self.composited_layers = []
+        add_parent_pointers(self.active_tab_display_list)
+        all_commands = []
+        for cmd in self.active_tab_display_list:
+            all_commands = \
+                tree_to_list(cmd, all_commands)
+        non_composited_commands = [cmd
+            for cmd in all_commands
+            if isinstance(cmd, PaintCommand) or \
+                not cmd.needs_compositing
+            if not cmd.parent or cmd.parent.needs_compositing
+        ]
+        for cmd in non_composited_commands:
+            did_break = False
+            for layer in reversed(self.composited_layers):
+                if layer.can_merge(cmd):
+                    layer.add(cmd)
+                    did_break = True
+                    break
+                elif skia.Rect.Intersects(
+                    layer.absolute_bounds(),
+                    local_to_absolute(cmd, cmd.rect)):
+                    layer = LegacyCompositedLayer(self.skia_context, cmd)
+                    self.composited_layers.append(layer)
+                    did_break = True
+                    break
+            if not did_break:
+                layer = LegacyCompositedLayer(self.skia_context, cmd)
+                self.composited_layers.append(layer)
+
+def make_row(rng, y, composited):
+    cmds = []
+    for i in range(COMMANDS_PER_ROW):
+        x = rng.randrange(0, 700)
+        cmds.append(DrawRect(skia.Rect.MakeXYWH(
+            x, y, rng.randrange(20, 100), ROW_HEIGHT), "gray"))
+    opacity = 0.5 if composited else 1.0
+    translation = (rng.randrange(-30, 30), 0) \
+        if rng.randrange(4) == 0 else None
+    rect = skia.Rect.MakeXYWH(0, y, 800, ROW_HEIGHT)
+    return Transform(translation, rect, None,
+        [Blend(opacity, None, None, cmds)])
+
+def make_display_list(rng, rows):
+    return [make_row(rng, i * ROW_HEIGHT, i % COMPOSITED_EVERY == 0)
+        for i in range(rows)]
+
+def layer_items(browser):
+    return [[id(item) for item in layer.display_items]
+        for layer in browser.composited_layers]
+
+def best_time(fn):
+    best = None
+    for i in range(REPEATS):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        if best == None or elapsed < best:
+            best = elapsed
+    return best
+
+if __name__ == "__main__":
+    wbetools.USE_COMPOSITING = True
+    print("  {:>6} {:>9} {:>7} {:>10} {:>10} {:>8}".format(
+        "rows", "commands", "layers", "legacy ms", "grid ms", "speedup"))
+    for rows in SIZES:
+        browser = BenchmarkBrowser(
+            make_display_list(random.Random(rows), rows))
+        legacy_time = best_time(browser.legacy_composite)
+        expected = layer_items(browser)
+        grid_time = best_time(browser.composite)
+        assert layer_items(browser) == expected
+        commands = sum([len(layer.display_items)
+            for layer in browser.composited_layers])
+        print("  {:>6} {:>9} {:>7} {:>10.1f} {:>10.1f} {:>7.1f}x".format(
+            rows, commands, len(browser.composited_layers),
+            legacy_time * 1000, grid_time * 1000, legacy_time / grid_time))
@@ -0,0 +1,196 @@
+"""
+Benchmarks the memory used by computed styles in Chapter 16, comparing
+the compact ComputedStyle storage with the original layout of one dict
+of ProtectedFields per node, each with its own invalidation set, and
+the throughput of ProtectedField's read, set, mark and notify against
+the original implementation.
+Run with: python3 benchmark16.py [number of entries]
+"""
+
+import sys
+import time
+import tracemalloc
+import wbetools
+from lab6 import RuleIndex
+from lab16 import HTMLParser, CSSParser, DEFAULT_STYLE_SHEET, \
+    CSS_PROPERTIES, INHERITED_PROPERTIES, cascade_priority, style, \
+    tree_to_list, ProtectedField
+
+ENTRIES = 10000
+FIELD_OPERATIONS = 200000
+FIELD_DEPENDENTS = 8
+
+class LegacyProtectedField:
+    def __init__(self, obj, name, parent=None, dependencies=None):
+        self.obj = obj
+        self.name = name
+        self.parent = parent
+
+        self.value = None
+        self.dirty = True
+        self.invalidations = set()
+        self.frozen_dependencies = (dependencies != None)
+        if dependencies != None:
+            for dependency in dependencies:
+                dependency.invalidations.add(self)
+        self.frozen_invalidations = False
+
+    def set_ancestor_dirty_bits(self):
+        parent = self.parent
+        while parent and not parent.has_dirty_descendants:
+            parent.has_dirty_descendants = True
+            parent = parent.parent
+
+    def mark(self):
+        if self.dirty: return
+        self.dirty = True
+        self.set_ancestor_dirty_bits()
+
+    def notify(self):
+        for field in self.invalidations:
+            field.mark()
+        self.set_ancestor_dirty_bits()
+
+    def set(self, value):
+        if value != self.value:
+            self.notify()
+        self.value = value
+        self.dirty = False
+
+    def get(self):
+        assert not self.dirty
+        return self.value
+
+    def read(self, notify):
+        if notify.frozen_dependencies or self.frozen_invalidations:
+            assert notify in self.invalidations
+        else:
+            self.invalidations.add(notify)
+
+        if wbetools.PRINT_INVALIDATION_DEPENDENCIES:
+            print("{} depends on {}".format(notify.name, self.name))
+
+        return self.get()
+
+def legacy_style(node):
+    node.legacy_style = dict([
+        (property, LegacyProtectedField(node, property, None,
+            [node.parent.legacy_style[property]] \
+                if node.parent and property in INHERITED_PROPERTIES \
+                else []))
+        for property in CSS_PROPERTIES
+    ])
+    for property, field in node.legacy_style.items():
+        field.value = node.style[property].value
+        field.dirty = False
+    for child in node.children:
+        legacy_style(child)
+
+class BenchmarkTab:
+    dark_mode = False
+
+class BenchmarkFrame:
+    tab = BenchmarkTab()
+
+    def set_needs_render(self):
+        pass
+
+class BenchmarkLayout:
+    parent = None
+    has_dirty_descendants = True
+
+def field_operations(field_class):
+    obj = BenchmarkLayout()
+    source = field_class(obj, "height", obj, [])
+    dependents = [field_class(obj, "height", obj, [source])
+        for i in range(FIELD_DEPENDENTS)]
+    source.set(0)
+    reader = dependents[0]
+
+    def read():
+        for i in range(FIELD_OPERATIONS):
+            source.read(notify=reader)
+
+    def set_unchanged():
+        for i in range(FIELD_OPERATIONS):
+            source.set(0)
+
+    def mark():
+        for i in range(FIELD_OPERATIONS):
+            reader.dirty = False
+            reader.mark()
+
+    def notify():
+        for i in range(FIELD_OPERATIONS // FIELD_DEPENDENTS):
+            for field in dependents:
+                field.dirty = False
+            source.set(i + 1)
+
+    return [("read", read), ("set, unchanged", set_unchanged),
+        ("mark", mark), ("set and notify {}".format(FIELD_DEPENDENTS),
+        notify)]
+
+def operations_per_second(fn):
+    best = None
+    for i in range(3):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        if best == None or elapsed < best:
+            best = elapsed
+    return FIELD_OPERATIONS / best
+
+def make_document(entries):
+    entry = "<div class=comment><p class=author>user{}</p>" + \
+        "<p>Some <b>bold</b> and <i>italic</i> text</p>" + \
+        "<span style=\"color: gray\">reply</span></div>"
+    return "<html><body>" + \
+        "".join([entry.format(i) for i in range(entries)]) + \
+        "</body></html>"
+
+def measure(fn):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return after - before, elapsed
+
+if __name__ == "__main__":
+    entries = int(sys.argv[1]) if len(sys.argv) > 1 else ENTRIES
+    nodes = HTMLParser(make_document(entries)).parse()
+    count = len(tree_to_list(nodes, []))
+    rules = RuleIndex(sorted(DEFAULT_STYLE_SHEET + CSSParser(
+        ".comment { background-color: white; } " +
+        ".author { font-weight: bold; }").parse(), key=cascade_priority))
+
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 10000))
+    compact, compact_time = measure(
+        lambda: style(nodes, rules, BenchmarkFrame()))
+    legacy, legacy_time = measure(lambda: legacy_style(nodes))
+
+    print("{} nodes, {} properties per node".format(
+        count, len(CSS_PROPERTIES)))
+    print("  {:<24} {:>12} {:>10} {:>10}".format(
+        "", "bytes/node", "total MB", "ms"))
+    print("  {:<24} {:>12.0f} {:>10.1f} {:>10.0f}".format(
+        "dict of ProtectedFields", legacy / count, legacy / 1e6,
+        legacy_time * 1000))
+    print("  {:<24} {:>12.0f} {:>10.1f} {:>10.0f}".format(
+        "ComputedStyle", compact / count, compact / 1e6,
+        compact_time * 1000))
+    print("  compact storage uses {:.1f}x less memory".format(
+        legacy / compact))
+
+    print("ProtectedField operations, {} per run".format(FIELD_OPERATIONS))
+    print("  {:<24} {:>12} {:>12} {:>8}".format(
+        "", "legacy Mop/s", "Mop/s", "speedup"))
+    for (name, legacy_fn), (name, fn) in zip(
+        field_operations(LegacyProtectedField),
+        field_operations(ProtectedField)):
+        legacy_rate = operations_per_second(legacy_fn)
+        rate = operations_per_second(fn)
+        print("  {:<24} {:>12.2f} {:>12.2f} {:>7.1f}x".format(
+            name, legacy_rate / 1e6, rate / 1e6, rate / legacy_rate))
@@ -0,0 +1,82 @@
+"""
+Benchmarks the HTML parser from Chapter 4 on large and deeply nested
+synthetic documents, checking that time grows linearly with size.
+Run with: python3 benchmark4.py
+"""
+
+import sys
+import time
+from lab4 import HTMLParser
+
+SIZES = [1000, 2000, 4000, 8000, 16000]
+REPEATS = 3
+MAX_SLOWDOWN = 1.5
+
+class TokenizeOnly(HTMLParser):
+    def add_text(self, text):
+        pass
+
+    def add_tag(self, tag):
+        self.get_attributes(tag)
+
+def large_document(n):
+    block = "<div class=\"item\" id=\"item{}\">" + \
+        "<p>Some <b>bold</b> and <i>italic</i> text &amp; more</p>" + \
+        "<!-- a comment -->" + \
+        "<script>var s = \"<p>not a tag</p>\";</script>" + \
+        "<img src='image.png' alt=\"a > b\"></div>\n"
+    return "<html><body>" + \
+        "".join([block.format(i) for i in range(n)]) + \
+        "</body></html>"
+
+def nested_document(n):
+    return "<html><body>" + "<div class=x>" * n + "text" + \
+        "</div>" * n + "<b><i>" * (n // 4) + "x" + \
+        "</b></i>" * (n // 4) + "</body></html>"
+
+def tokenize(body):
+    parser = TokenizeOnly(body)
+    parser.eof = True
+    parser.tokenize()
+
+def parse(body):
+    HTMLParser(body).parse()
+
+def best_time(fn, body):
+    best = None
+    for i in range(REPEATS):
+        start = time.perf_counter()
+        fn(body)
+        elapsed = time.perf_counter() - start
+        if best == None or elapsed < best:
+            best = elapsed
+    return best
+
+def benchmark(name, make_document, fn):
+    print("{} ({})".format(name, fn.__name__))
+    print("  {:>8} {:>10} {:>10} {:>12}".format(
+        "n", "KB", "ms", "us/KB"))
+    per_kb = []
+    for n in SIZES:
+        body = make_document(n)
+        kb = len(body) / 1024
+        elapsed = best_time(fn, body)
+        per_kb.append(elapsed * 1e6 / kb)
+        print("  {:>8} {:>10.1f} {:>10.2f} {:>12.2f}".format(
+            n, kb, elapsed * 1000, per_kb[-1]))
+    slowdown = per_kb[-1] / per_kb[0]
+    linear = slowdown <= MAX_SLOWDOWN
+    print("  time per KB grew {:.2f}x over a {}x size increase: {}".format(
+        slowdown, SIZES[-1] // SIZES[0],
+        "linear" if linear else "SUPERLINEAR"))
+    return linear
+
+if __name__ == "__main__":
+    results = [
+        benchmark("large document", large_document, tokenize),
+        benchmark("nested document", nested_document, tokenize),
+        benchmark("large document", large_document, parse),
+        benchmark("nested document", nested_document, parse),
+    ]
+    if not all(results):
+        sys.exit(1)
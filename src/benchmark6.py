@@ -0,0 +1,142 @@
+"""
+Benchmarks selector matching from Chapter 6 on a class-heavy page and
+stylesheet, comparing compiled selectors against the original selectors
+that dispatch through method calls and re-split the class attribute on
+every match.
+Run with: python3 benchmark6.py
+"""
+
+import random
+import time
+from lab4 import Element, HTMLParser
+from lab6 import CSSParser, TagSelector, ClassSelector, DescendantSelector
+from lab6 import RuleIndex, style, tree_to_list
+
+ENTRIES = 500
+DEPTH = 8
+CLASSES = 200
+RULES = 400
+REPEATS = 3
+
+class LegacyTagSelector(TagSelector):
+    def compile(self):
+        return self.legacy_matches
+
+    def legacy_matches(self, node):
+        return isinstance(node, Element) and self.tag == node.tag
+
+class LegacyClassSelector(ClassSelector):
+    def compile(self):
+        return self.legacy_matches
+
+    def legacy_matches(self, node):
+        if not isinstance(node, Element): return False
+        classes = node.attributes.get("class", "").split()
+        return self.class_name in classes
+
+class LegacyDescendantSelector(DescendantSelector):
+    def compile(self):
+        return self.legacy_matches
+
+    def legacy_matches(self, node):
+        if not self.descendant.matches(node): return False
+        while node.parent:
+            if self.ancestor.matches(node.parent): return True
+            node = node.parent
+        return False
+
+def legacy(selector):
+    if isinstance(selector, TagSelector):
+        return LegacyTagSelector(selector.tag)
+    elif isinstance(selector, ClassSelector):
+        return LegacyClassSelector(selector.class_name)
+    else:
+        return LegacyDescendantSelector(
+            legacy(selector.ancestor), legacy(selector.descendant))
+
+def class_names(rng, n):
+    return " ".join(["c{}".format(rng.randrange(CLASSES))
+        for i in range(n)])
+
+def make_tree(rng):
+    entry = "<div><div><p>Some <b>bold</b> text</p>" + \
+        "<span>more</span></div></div>"
+    tree = HTMLParser("<html><body>" + "<div>" * DEPTH +
+        entry * ENTRIES + "</div>" * DEPTH + "</body></html>").parse()
+    # The Chapter 4 parser has no quoted attributes, so add class lists
+    for node in tree_to_list(tree, []):
+        if isinstance(node, Element):
+            node.attributes["class"] = class_names(rng, rng.randrange(1, 6))
+    return tree
+
+def make_stylesheet(rng):
+    rules = []
+    for i in range(RULES):
+        kind = rng.randrange(3)
+        if kind == 0:
+            selector = ".c{}".format(rng.randrange(CLASSES))
+        elif kind == 1:
+            selector = ".c{} .c{}".format(
+                rng.randrange(CLASSES), rng.randrange(CLASSES))
+        else:
+            selector = "div .c{}".format(rng.randrange(CLASSES))
+        rules.append(selector + " { color: red; }")
+    return "\n".join(rules)
+
+def match_all(nodes, selectors):
+    return [[selector.matches(node) for selector in selectors]
+        for node in nodes]
+
+def best_time(fn):
+    best = None
+    for i in range(REPEATS):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        if best == None or elapsed < best:
+            best = elapsed
+    return best, result
+
+if __name__ == "__main__":
+    rng = random.Random(0)
+    tree = make_tree(rng)
+    nodes = tree_to_list(tree, [])
+    rules = CSSParser(make_stylesheet(rng)).parse()
+    selectors = [selector for selector, body in rules]
+    legacy_selectors = [legacy(selector) for selector in selectors]
+
+    print("{} nodes, {} rules".format(len(nodes), len(rules)))
+    print("  {:<34} {:>10} {:>10} {:>8}".format(
+        "", "legacy ms", "compiled ms", "speedup"))
+
+    legacy_time, expected = best_time(
+        lambda: match_all(nodes, legacy_selectors))
+    compiled_time, actual = best_time(
+        lambda: match_all(nodes, selectors))
+    assert expected == actual
+    print("  {:<34} {:>10.1f} {:>10.1f} {:>7.1f}x".format(
+        "match every selector to every node", legacy_time * 1000,
+        compiled_time * 1000, legacy_time / compiled_time))
+
+    legacy_time, expected = best_time(lambda: [
+        [node for node in nodes if selector.matches(node)]
+        for selector in legacy_selectors])
+    compiled_time, actual = best_time(lambda: [
+        [node for node in nodes if selector.matches(node)]
+        for selector in selectors])
+    assert expected == actual
+    print("  {:<34} {:>10.1f} {:>10.1f} {:>7.1f}x".format(
+        "querySelectorAll per selector", legacy_time * 1000,
+        compiled_time * 1000, legacy_time / compiled_time))
+
+    legacy_rules = [(legacy(selector), body) for selector, body in rules]
+    legacy_time, expected = best_time(lambda: (
+        style(tree, RuleIndex(legacy_rules)),
+        [node.style for node in nodes])[1])
+    compiled_time, actual = best_time(lambda: (
+        style(tree, RuleIndex(rules)),
+        [node.style for node in nodes])[1])
+    assert expected == actual
+    print("  {:<34} {:>10.1f} {:>10.1f} {:>7.1f}x".format(
+        "style() with a RuleIndex", legacy_time * 1000,
+        compiled_time * 1000, legacy_time / compiled_time))
@@ -5,6 +5,7 @@ without exercises.
 """
 
 import sys
+import collections
 import ctypes
 import dukpy
 import math
@@ -12,9 +13,11 @@ import sdl2
 import skia
 import socket
 import ssl
+import threading
 import urllib.parse
 import wbetools
 from lab2 import WIDTH, HEIGHT, HSTEP, VSTEP, SCROLL_STEP
+from lab3 import WordWidthCache
 from lab4 import print_tree, HTMLParser
 from lab5 import BLOCK_ELEMENTS
 from lab6 import CSSParser, TagSelector, DescendantSelector
@@ -28,8 +31,33 @@ from lab9 import RUNTIME_JS, EVENT_DISPATCH_JS
 from lab10 import COOKIE_JAR, URL, JSContext, Tab
 
 FONTS = {}
+FONT_CACHE_SIZE = 256
+FONT_CACHE = collections.OrderedDict()
+FONT_KEYS = {}
+FONT_LOCK = threading.Lock()
+
+class FontMetrics:
+    def __init__(self, font, key=None):
+        self.key = key
+        metrics = font.getMetrics()
+        self.ascent = metrics.fAscent
+        self.descent = metrics.fDescent
+        self.linespace = metrics.fDescent - metrics.fAscent
+        self.space = font.measureText(" ")
+
+    @wbetools.js_hide
+    def __repr__(self):
+        return ("FontMetrics(ascent={} descent={} linespace={} " +
+            "space={})").format(self.ascent, self.descent,
+            self.linespace, self.space)
 
 def get_font(size, weight, style):
+    font_key = (size, weight, style)
+    FONT_LOCK.acquire(blocking=True)
+    entry = FONT_CACHE.get(font_key)
+    if entry: FONT_CACHE.move_to_end(font_key)
+    FONT_LOCK.release()
+    if entry: return entry[0]
     key = (weight, style)
     if key not in FONTS:
         if weight == "bold":
@@ -45,7 +73,33 @@ def get_font(size, weight, style):
             skia.FontStyle(skia_weight, skia_width, skia_style)
         font = skia.Typeface('Arial', style_info)
         FONTS[key] = font
-    return skia.Font(FONTS[key], size)
+    font = skia.Font(FONTS[key], size)
+    metrics = FontMetrics(font, font_key)
+    FONT_LOCK.acquire(blocking=True)
+    entry = FONT_CACHE.setdefault(font_key, (font, metrics))
+    if entry[0] is font:
+        FONT_KEYS[id(font)] = font_key
+        while len(FONT_CACHE) > FONT_CACHE_SIZE:
+            old_font, old_metrics = FONT_CACHE.popitem(last=False)[1]
+            del FONT_KEYS[id(old_font)]
+    FONT_LOCK.release()
+    return entry[0]
+
+def font_metrics(font):
+    # Fonts stay in FONT_CACHE while they are in FONT_KEYS, so their
+    # ids can't be reused; a font with the same key has equal metrics
+    entry = FONT_CACHE.get(FONT_KEYS.get(id(font)))
+    if not entry:
+        return FontMetrics(font)
+    return entry[1]
+
+WORD_WIDTHS = WordWidthCache("skia")
+
+def measure_word(font, word):
+    entry = FONT_CACHE.get(FONT_KEYS.get(id(font)))
+    if not entry:
+        return font.measureText(word)
+    return WORD_WIDTHS.measure(entry[1].key, word, font.measureText)
 
 NAMED_COLORS = {
     "black": "#000000",
@@ -90,8 +144,7 @@ def parse_blend_mode(blend_mode_str):
         return skia.BlendMode.kSrcOver
 
 def linespace(font):
-    metrics = font.getMetrics()
-    return metrics.fDescent - metrics.fAscent
+    return font_metrics(font).linespace
 
 class Blend:
     def __init__(self, opacity, blend_mode, children):
@@ -140,8 +193,7 @@ class DrawText:
         self.rect = skia.Rect.MakeLTRB(
             x1, y1,
             x1 + font.measureText(text),
-            y1 - font.getMetrics().fAscent \
-                + font.getMetrics().fDescent)
+            y1 + font_metrics(font).linespace)
         self.font = font
         self.text = text
         self.color = color
@@ -152,7 +204,7 @@ class DrawText:
             Color=parse_color(self.color),
         )
         baseline = self.rect.top() \
-            - self.font.getMetrics().fAscent
+            - font_metrics(self.font).ascent
         canvas.drawString(self.text, float(self.rect.left()),
             baseline, self.font, paint)
 
@@ -220,14 +272,14 @@ class BlockLayout:
         style = node.style["font-style"]
         size = float(node.style["font-size"][:-2]) * 0.75
         font = get_font(size, weight, style)
-        w = font.measureText(word)
+        w = measure_word(font, word)
         if self.cursor_x + w > self.width:
             self.new_line()
         line = self.children[-1]
         previous_word = line.children[-1] if line.children else None
         text = TextLayout(node, word, line, previous_word)
         line.children.append(text)
-        self.cursor_x += w + font.measureText(" ")
+        self.cursor_x += w + font_metrics(font).space
 
     def input(self, node):
         w = INPUT_WIDTH_PX
@@ -241,7 +293,7 @@ class BlockLayout:
         style = node.style["font-style"]
         size = float(node.style["font-size"][:-2]) * 0.75
         font = get_font(size, weight, style)
-        self.cursor_x += w + font.measureText(" ")
+        self.cursor_x += w + font_metrics(font).space
 
     def self_rect(self):
         return skia.Rect.MakeLTRB(
@@ -286,12 +338,12 @@ class LineLayout:
             self.height = 0
             return
 
-        max_ascent = max([-word.font.getMetrics().fAscent 
+        max_ascent = max([-font_metrics(word.font).ascent
                           for word in self.children])
         baseline = self.y + 1.25 * max_ascent
         for word in self.children:
-            word.y = baseline + word.font.getMetrics().fAscent
-        max_descent = max([word.font.getMetrics().fDescent
+            word.y = baseline + font_metrics(word.font).ascent
+        max_descent = max([font_metrics(word.font).descent
                            for word in self.children])
         self.height = 1.25 * (max_ascent + max_descent)
 
@@ -310,10 +362,10 @@ class TextLayout:
         self.font = get_font(size, weight, style)
 
         # Do not set self.y!!!
-        self.width = self.font.measureText(self.word)
+        self.width = measure_word(self.font, self.word)
 
         if self.previous:
-            space = self.previous.font.measureText(" ")
+            space = font_metrics(self.previous.font).space
             self.x = self.previous.x + space + self.previous.width
         else:
             self.x = self.parent.x
@@ -342,7 +394,7 @@ class InputLayout:
         self.height = linespace(self.font)
 
         if self.previous:
-            space = self.previous.font.measureText(" ")
+            space = font_metrics(self.previous.font).space
             self.x = self.previous.x + space + self.previous.width
         else:
             self.x = self.parent.x
@@ -32,6 +32,7 @@ from lab11 import linespace, DrawText, Blend
 from lab11 import DocumentLayout, BlockLayout, LineLayout, TextLayout, InputLayout, Chrome
 from lab11 import Tab, Browser, paint_tree, paint_visual_effects
 from lab11 import parse_color, parse_blend_mode, NAMED_COLORS, FONTS
+from lab11 import WORD_WIDTHS
 
 class MeasureTime:
     def __init__(self):
@@ -736,6 +737,7 @@ class Browser:
 
     def handle_quit(self):
         self.measure.finish()
+        WORD_WIDTHS.save()
         for tab in self.tabs:
             tab.task_runner.set_needs_quit()
         sdl2.SDL_DestroyWindow(self.sdl_window)
@@ -4,9 +4,11 @@ up to and including Chapter 13 (Animations and Compositing),
 without exercises.
 """
 
+import bisect
 import ctypes
 import dukpy
 import math
+import re
 import sdl2
 import skia
 import socket
@@ -21,12 +23,13 @@ from lab2 import WIDTH, HEIGHT, HSTEP, VSTEP, SCROLL_STEP
 from lab4 import print_tree, HTMLParser
 from lab5 import BLOCK_ELEMENTS
 from lab6 import TagSelector, DescendantSelector
-from lab6 import INHERITED_PROPERTIES, cascade_priority
-from lab6 import tree_to_list, CSSParser
+from lab6 import INHERITED_PROPERTIES, cascade_priority, RuleIndex
+from lab6 import tree_to_list, CSSParser, parse_inline_style
 from lab8 import Text, Element, INPUT_WIDTH_PX, DEFAULT_STYLE_SHEET
 from lab9 import EVENT_DISPATCH_JS
 from lab10 import COOKIE_JAR, URL
 from lab11 import FONTS, get_font, parse_color, NAMED_COLORS, parse_blend_mode, linespace
+from lab11 import font_metrics, WORD_WIDTHS
 from lab11 import paint_tree, BlockLayout, DocumentLayout, LineLayout, TextLayout, InputLayout
 from lab12 import MeasureTime, SingleThreadedTaskRunner, TaskRunner
 from lab12 import Tab, Browser, Task, REFRESH_RATE_SEC, Chrome, JSContext
@@ -163,14 +166,14 @@ class DrawText(PaintCommand):
         super().__init__(skia.Rect.MakeLTRB(
             x1, y1,
             x1 + font.measureText(text),
-            y1 - font.getMetrics().fAscent + font.getMetrics().fDescent))
+            y1 + font_metrics(font).linespace))
 
     def execute(self, canvas):
         paint = skia.Paint(
             AntiAlias=True,
             Color=parse_color(self.color)
         )
-        baseline = self.rect.top() - self.font.getMetrics().fAscent
+        baseline = self.rect.top() - font_metrics(self.font).ascent
         canvas.drawString(self.text, float(self.rect.left()), baseline,
             self.font, paint)
 
@@ -300,34 +303,34 @@ def parse_transform(transform_str):
         transform_str[left_paren + 1:right_paren].split(",")
     return (float(x_px[:-2]), float(y_px[:-2]))
 
+CSS_WORD = re.compile(r"(?:[\w,/#.%()\"-]|'[\w,/#.%()\":-]*'?)*")
+CSS_DECLARATION = re.compile(
+    r"(?=((?:[\w,/#.%()\"-]|'[\w,/#.%()\":-]*'?)+))\1" +
+    r"\s*:\s*([^;}]*);?\s*")
+
 @wbetools.patch(CSSParser)
 class CSSParser:
     def word(self):
         start = self.i
-        in_quote = False
-        while self.i < len(self.s):
-            cur = self.s[self.i]
-            if cur == "'":
-                in_quote = not in_quote
-            if cur.isalnum() or cur in ",/#-.%()\"'" \
-                or (in_quote and cur == ':'):
-                self.i += 1
-            else:
-                break
+        self.i = CSS_WORD.match(self.s, start).end()
+        underscore = self.s.find("_", start, self.i)
+        if underscore >= 0:
+            self.i = underscore
         if not (self.i > start):
-            raise Exception("Parsing error")
+            return None
         return self.s[start:self.i]
 
     def until_chars(self, chars):
         start = self.i
-        while self.i < len(self.s) and self.s[self.i] not in chars:
-            self.i += 1
+        pattern = re.compile("[^" + re.escape("".join(chars)) + "]*")
+        self.i = pattern.match(self.s, start).end()
         return self.s[start:self.i]
 
     def pair(self, until):
         prop = self.word()
+        if prop is None: return None
         self.whitespace()
-        self.literal(":")
+        if not self.literal(":"): return None
         self.whitespace()
         val = self.until_chars(until)
         return prop.casefold(), val.strip()
@@ -335,19 +338,25 @@ class CSSParser:
     def body(self):
         pairs = {}
         while self.i < len(self.s) and self.s[self.i] != "}":
-            try:
-                prop, val = self.pair([";", "}"])
+            m = CSS_DECLARATION.match(self.s, self.i)
+            if m and "_" not in m.group(1):
+                pairs[m.group(1).casefold()] = m.group(2).strip()
+                self.i = m.end()
+                continue
+            pair = self.pair([";", "}"])
+            if pair:
+                prop, val = pair
                 pairs[prop] = val
                 self.whitespace()
+                if self.literal(";"):
+                    self.whitespace()
+                    continue
+            why = self.ignore_until([";", "}"])
+            if why == ";":
                 self.literal(";")
                 self.whitespace()
-            except Exception:
-                why = self.ignore_until([";", "}"])
-                if why == ";":
-                    self.literal(";")
-                    self.whitespace()
-                else:
-                    break
+            else:
+                break
         return pairs
 
 @wbetools.patch(BlockLayout)
@@ -523,6 +532,8 @@ class NumericAnimation:
             num_frames=self.num_frames)
     
 def style(node, rules, tab):
+    if not isinstance(rules, RuleIndex):
+        rules = RuleIndex(rules)
     old_style = node.style
 
     node.style = {}
@@ -531,12 +542,12 @@ def style(node, rules, tab):
             node.style[property] = node.parent.style[property]
         else:
             node.style[property] = default_value
-    for selector, body in rules:
+    for selector, body in rules.candidates(node):
         if not selector.matches(node): continue
         for property, value in body.items():
             node.style[property] = value
     if isinstance(node, Element) and "style" in node.attributes:
-        pairs = CSSParser(node.attributes["style"]).body()
+        pairs = parse_inline_style(node.attributes["style"])
         for property, value in pairs.items():
             node.style[property] = value
     if node.style["font-size"].endswith("%"):
@@ -559,8 +570,10 @@ def style(node, rules, tab):
                 node.animations[property] = animation
                 node.style[property] = animation.animate()
 
+    rules.push_ancestor(node)
     for child in node.children:
         style(child, rules, tab)
+    rules.pop_ancestor()
 
 @wbetools.patchable
 def absolute_bounds_for_obj(obj):
@@ -595,6 +608,8 @@ class CompositedLayer:
         self.surface = None
         self.display_items = [display_item]
         self.parent = display_item.parent
+        self.bounds = skia.Rect.MakeEmpty()
+        self.bounds.join(local_to_absolute(display_item, display_item.rect))
 
     def can_merge(self, display_item):
         return display_item.parent == \
@@ -603,6 +618,7 @@ class CompositedLayer:
     def add(self, display_item):
         assert self.can_merge(display_item)
         self.display_items.append(display_item)
+        self.bounds.join(local_to_absolute(display_item, display_item.rect))
 
     def composited_bounds(self):
         rect = skia.Rect.MakeEmpty()
@@ -613,10 +629,7 @@ class CompositedLayer:
         return rect
 
     def absolute_bounds(self):
-        rect = skia.Rect.MakeEmpty()
-        for item in self.display_items:
-            rect.join(local_to_absolute(item, item.rect))
-        return rect
+        return self.bounds.makeOffset(0.0, 0.0)
 
     def raster(self):
         bounds = self.composited_bounds()
@@ -656,6 +669,47 @@ class CompositedLayer:
             self.composited_bounds(), self.absolute_bounds(),
             self.display_items if len(self.display_items) > 0 else 'None')
 
+LAYER_GRID_SIZE = 256
+
+class LayerGrid:
+    def __init__(self, size=LAYER_GRID_SIZE):
+        self.size = size
+        self.cells = {}
+        self.ranges = {}
+
+    def cell_range(self, rect):
+        return (math.floor(rect.left() / self.size),
+            math.floor(rect.top() / self.size),
+            math.floor(rect.right() / self.size),
+            math.floor(rect.bottom() / self.size))
+
+    def insert(self, index, rect):
+        if rect.isEmpty(): return
+        old = self.ranges.get(index)
+        new = self.cell_range(rect)
+        if old == new: return
+        self.ranges[index] = new
+        left, top, right, bottom = new
+        for x in range(left, right + 1):
+            for y in range(top, bottom + 1):
+                if old and old[0] <= x <= old[2] and \
+                    old[1] <= y <= old[3]:
+                    continue
+                bisect.insort(self.cells.setdefault((x, y), []), index)
+
+    def last_overlap(self, rect, layers):
+        if rect.isEmpty(): return None
+        found = None
+        left, top, right, bottom = self.cell_range(rect)
+        for x in range(left, right + 1):
+            for y in range(top, bottom + 1):
+                for index in reversed(self.cells.get((x, y), [])):
+                    if found != None and index <= found: break
+                    if skia.Rect.Intersects(layers[index].bounds, rect):
+                        found = index
+                        break
+        return found
+
 @wbetools.patch(Tab)
 class Tab:
     def __init__(self, browser, tab_height):
@@ -951,23 +1005,21 @@ class Browser:
                 not cmd.needs_compositing
             if not cmd.parent or cmd.parent.needs_compositing
         ]
+        grid = LayerGrid()
+        last_layer_for_parent = {}
         for cmd in non_composited_commands:
-            did_break = False
-            for layer in reversed(self.composited_layers):
-                if layer.can_merge(cmd):
-                    layer.add(cmd)
-                    did_break = True
-                    break
-                elif skia.Rect.Intersects(
-                    layer.absolute_bounds(),
-                    local_to_absolute(cmd, cmd.rect)):
-                    layer = CompositedLayer(self.skia_context, cmd)
-                    self.composited_layers.append(layer)
-                    did_break = True
-                    break
-            if not did_break:
+            merge = last_layer_for_parent.get(cmd.parent)
+            overlap = grid.last_overlap(
+                local_to_absolute(cmd, cmd.rect), self.composited_layers)
+            if merge != None and (overlap == None or merge >= overlap):
+                index = merge
+                self.composited_layers[index].add(cmd)
+            else:
+                index = len(self.composited_layers)
                 layer = CompositedLayer(self.skia_context, cmd)
                 self.composited_layers.append(layer)
+                last_layer_for_parent[cmd.parent] = index
+            grid.insert(index, self.composited_layers[index].bounds)
 
         self.active_tab_height = 0
         for layer in self.composited_layers:
@@ -1140,6 +1192,7 @@ class Browser:
 
     def handle_quit(self):
         self.measure.finish()
+        WORD_WIDTHS.save()
         for tab in self.tabs:
             tab.task_runner.set_needs_quit()
         if wbetools.USE_GPU:
@@ -29,12 +29,13 @@ from lab2 import WIDTH, HEIGHT, HSTEP, VSTEP, SCROLL_STEP
 from lab4 import Text, Element, print_tree, HTMLParser
 from lab5 import BLOCK_ELEMENTS
 from lab6 import TagSelector, DescendantSelector
-from lab6 import INHERITED_PROPERTIES
-from lab6 import tree_to_list
+from lab6 import INHERITED_PROPERTIES, RuleIndex
+from lab6 import tree_to_list, node_classes, parse_inline_style
 from lab8 import INPUT_WIDTH_PX
 from lab9 import EVENT_DISPATCH_JS
 from lab10 import COOKIE_JAR, URL
 from lab11 import FONTS, NAMED_COLORS, get_font, linespace, paint_tree
+from lab11 import font_metrics, measure_word
 from lab11 import parse_color, parse_blend_mode
 from lab11 import DocumentLayout, LineLayout
 from lab12 import MeasureTime, SingleThreadedTaskRunner, TaskRunner, Chrome
@@ -136,14 +137,14 @@ class BlockLayout:
         px_size = float(node.style["font-size"][:-2])
         size = dpx(px_size * 0.75, self.zoom)
         font = get_font(size, weight, size)
-        w = font.measureText(word)
+        w = measure_word(font, word)
         if self.cursor_x + w > self.width:
             self.new_line()
         line = self.children[-1]
         previous_word = line.children[-1] if line.children else None
         text = TextLayout(node, word, line, previous_word)
         line.children.append(text)
-        self.cursor_x += w + font.measureText(" ")
+        self.cursor_x += w + font_metrics(font).space
 
     def input(self, node):
         w = dpx(INPUT_WIDTH_PX, self.zoom)
@@ -158,7 +159,7 @@ class BlockLayout:
         px_size = float(node.style["font-size"][:-2])
         size = dpx(px_size * 0.75, self.zoom)
         font = get_font(size, weight, size)
-        self.cursor_x += w + font.measureText(" ")
+        self.cursor_x += w + font_metrics(font).space
 
     def paint(self):
         cmds = []
@@ -191,12 +192,12 @@ class LineLayout:
             self.height = 0
             return
 
-        max_ascent = max([-word.font.getMetrics().fAscent 
+        max_ascent = max([-font_metrics(word.font).ascent
                           for word in self.children])
         baseline = self.y + 1.25 * max_ascent
         for word in self.children:
-            word.y = baseline + word.font.getMetrics().fAscent
-        max_descent = max([word.font.getMetrics().fDescent
+            word.y = baseline + font_metrics(word.font).ascent
+        max_descent = max([font_metrics(word.font).descent
                            for word in self.children])
         self.height = 1.25 * (max_ascent + max_descent)
 
@@ -230,30 +231,35 @@ def cascade_priority(rule):
 def style(node, rules, tab):
     old_style = node.style
 
-    node.style = {}
-    for property, default_value in INHERITED_PROPERTIES.items():
-        if node.parent:
-            node.style[property] = node.parent.style[property]
-        else:
-            node.style[property] = default_value
-    for media, selector, body in rules:
-        if media:
-            if (media == "dark") != tab.dark_mode: continue
-        if not selector.matches(node): continue
-        for property, value in body.items():
-            node.style[property] = value
-    if isinstance(node, Element) and "style" in node.attributes:
-        pairs = CSSParser(node.attributes["style"]).body()
-        for property, value in pairs.items():
-            node.style[property] = value
-    if node.style["font-size"].endswith("%"):
-        if node.parent:
-            parent_font_size = node.parent.style["font-size"]
-        else:
-            parent_font_size = INHERITED_PROPERTIES["font-size"]
-        node_pct = float(node.style["font-size"][:-1]) / 100
-        parent_px = float(parent_font_size[:-2])
-        node.style["font-size"] = str(node_pct * parent_px) + "px"
+    key, shared = rules.lookup_style(node)
+    if shared:
+        node.style = shared.copy()
+    else:
+        node.style = {}
+        for property, default_value in INHERITED_PROPERTIES.items():
+            if node.parent:
+                node.style[property] = node.parent.style[property]
+            else:
+                node.style[property] = default_value
+        for media, selector, body in rules.candidates(node):
+            if media:
+                if (media == "dark") != tab.dark_mode: continue
+            if not selector.matches(node): continue
+            for property, value in body.items():
+                node.style[property] = value
+        if isinstance(node, Element) and "style" in node.attributes:
+            pairs = parse_inline_style(node.attributes["style"])
+            for property, value in pairs.items():
+                node.style[property] = value
+        if node.style["font-size"].endswith("%"):
+            if node.parent:
+                parent_font_size = node.parent.style["font-size"]
+            else:
+                parent_font_size = INHERITED_PROPERTIES["font-size"]
+            node_pct = float(node.style["font-size"][:-1]) / 100
+            parent_px = float(parent_font_size[:-2])
+            node.style["font-size"] = str(node_pct * parent_px) + "px"
+        rules.store_style(node, key, node.style.copy())
 
     if old_style:
         transitions = diff_styles(old_style, node.style)
@@ -266,8 +272,10 @@ def style(node, rules, tab):
                 node.animations[property] = animation
                 node.style[property] = animation.animate()
 
+    rules.push_ancestor(node)
     for child in node.children:
         style(child, rules, tab)
+    rules.pop_ancestor()
 
 @wbetools.patch(DocumentLayout)
 class DocumentLayout:
@@ -300,10 +308,10 @@ class TextLayout:
         self.font = get_font(size, weight, style)
 
         # Do not set self.y!!!
-        self.width = self.font.measureText(self.word)
+        self.width = measure_word(self.font, self.word)
 
         if self.previous:
-            space = self.previous.font.measureText(" ")
+            space = font_metrics(self.previous.font).space
             self.x = self.previous.x + space + self.previous.width
         else:
             self.x = self.parent.x
@@ -340,7 +348,7 @@ class InputLayout:
         self.height = linespace(self.font)
 
         if self.previous:
-            space = self.previous.font.measureText(" ")
+            space = font_metrics(self.previous.font).space
             self.x = self.previous.x + space + self.previous.width
         else:
             self.x = self.parent.x
@@ -509,82 +517,107 @@ class PseudoclassSelector:
         self.pseudoclass = pseudoclass
         self.base = base
         self.priority = self.base.priority
+        self.matches = self.compile()
 
-    def matches(self, node):
-        if not self.base.matches(node):
-            return False
+    def compile(self):
+        base = self.base.matches
         if self.pseudoclass == "focus":
-            return node.is_focused
+            return lambda node: base(node) and node.is_focused
         else:
-            return False
+            return lambda node: False
+
+    def index_key(self):
+        return ("pseudoclass", self.pseudoclass)
+
+    def filter_keys(self):
+        return self.base.filter_keys()
 
     @wbetools.js_hide
     def __repr__(self):
         return "PseudoclassSelector({}, {})".format(self.pseudoclass, self.base)
 
+@wbetools.patch(RuleIndex)
+class RuleIndex:
+    def node_keys(self, node):
+        keys = [("tag", node.tag)]
+        for class_name in node_classes(node):
+            keys.append(("class", class_name))
+        if node.is_focused:
+            keys.append(("pseudoclass", "focus"))
+        return keys
+
 @wbetools.patch(CSSParser)
 class CSSParser:
     def simple_selector(self):
-        out = TagSelector(self.word().casefold())
+        word = self.word()
+        if word is None: return None
+        out = TagSelector(word.casefold())
         if self.i < len(self.s) and self.s[self.i] == ":":
             self.literal(":")
-            pseudoclass = self.word().casefold()
-            out = PseudoclassSelector(pseudoclass, out)
+            pseudoclass = self.word()
+            if pseudoclass is None: return None
+            out = PseudoclassSelector(pseudoclass.casefold(), out)
         return out
 
     def selector(self):
         out = self.simple_selector()
+        if out is None: return None
         self.whitespace()
         while self.i < len(self.s) and self.s[self.i] != "{":
             descendant = self.simple_selector()
+            if descendant is None: return None
             out = DescendantSelector(out, descendant)
             self.whitespace()
         return out
 
     def media_query(self):
-        self.literal("@")
-        assert self.word() == "media"
+        if not self.literal("@"): return None
+        if self.word() != "media": return None
         self.whitespace()
-        self.literal("(")
+        if not self.literal("("): return None
         self.whitespace()
-        prop, val = self.pair([")"])
+        pair = self.pair([")"])
+        if pair is None: return None
         self.whitespace()
-        self.literal(")")
-        return prop, val
+        if not self.literal(")"): return None
+        return pair
 
     def parse(self):
         rules = []
         media = None
         self.whitespace()
         while self.i < len(self.s):
-            try:
-                if self.s[self.i] == "@" and not media:
-                    prop, val = self.media_query()
+            if self.s[self.i] == "@" and not media:
+                pair = self.media_query()
+                if pair:
+                    prop, val = pair
                     if prop == "prefers-color-scheme" and \
                         val in ["dark", "light"]:
                         media = val
                     self.whitespace()
-                    self.literal("{")
-                    self.whitespace()
-                elif self.s[self.i] == "}" and media:
-                    self.literal("}")
-                    media = None
-                    self.whitespace()
-                else:
-                    selector = self.selector()
-                    self.literal("{")
+                    if self.literal("{"):
+                        self.whitespace()
+                        continue
+            elif self.s[self.i] == "}" and media:
+                self.literal("}")
+                media = None
+                self.whitespace()
+                continue
+            else:
+                selector = self.selector()
+                if selector and self.literal("{"):
                     self.whitespace()
                     body = self.body()
-                    self.literal("}")
-                    self.whitespace()
-                    rules.append((media, selector, body))
-            except Exception:
-                why = self.ignore_until(["}"])
-                if why == "}":
-                    self.literal("}")
-                    self.whitespace()
-                else:
-                    break
+                    if self.literal("}"):
+                        self.whitespace()
+                        rules.append((media, selector, body))
+                        continue
+            why = self.ignore_until(["}"])
+            if why == "}":
+                self.literal("}")
+                self.whitespace()
+            else:
+                break
         return rules
 
 DEFAULT_STYLE_SHEET = CSSParser(open("browser14.css").read()).parse()
@@ -655,6 +688,7 @@ class Tab:
         self.dark_mode = browser.dark_mode
         self.loaded = False
         self.js = None
+        self.rule_index = None
 
         self.accessibility_tree = None
 
@@ -725,6 +759,7 @@ class Tab:
             except:
                 continue
             self.rules.extend(CSSParser(body).parse())
+        self.rule_index = None
         self.set_needs_render()
         self.loaded = True
 
@@ -785,8 +820,10 @@ class Tab:
                 INHERITED_PROPERTIES["color"] = "white"
             else:
                 INHERITED_PROPERTIES["color"] = "black"
-            style(self.nodes,
-                sorted(self.rules, key=cascade_priority), self)
+            if not self.rule_index:
+                self.rule_index = RuleIndex(
+                    sorted(self.rules, key=cascade_priority))
+            style(self.nodes, self.rule_index, self)
             self.needs_layout = True
             self.needs_style = False
 
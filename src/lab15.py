@@ -5,11 +5,17 @@ without exercises.
 """
 
 import sys
+import codecs
+import collections
 import ctypes
 import dukpy
 import gtts
+import hashlib
+import heapq
+import json
 import math
 import os
+import re
 import sdl2
 import skia
 import socket
@@ -20,15 +26,18 @@ import urllib.parse
 import wbetools
 import OpenGL.GL
 
+from lab1 import Cache
 from lab2 import WIDTH, HEIGHT, HSTEP, VSTEP, SCROLL_STEP
 from lab4 import print_tree, HTMLParser
 from lab5 import BLOCK_ELEMENTS
 from lab14 import Text, Element
 from lab6 import TagSelector, DescendantSelector
-from lab6 import tree_to_list, INHERITED_PROPERTIES
+from lab6 import tree_to_list, INHERITED_PROPERTIES, RuleIndex
+from lab6 import parse_inline_style
 from lab8 import INPUT_WIDTH_PX
 from lab10 import COOKIE_JAR, URL
-from lab11 import FONTS, NAMED_COLORS, get_font, linespace
+from lab11 import FONTS, NAMED_COLORS, get_font, linespace, font_metrics
+from lab11 import measure_word
 from lab11 import parse_color, parse_blend_mode
 from lab12 import MeasureTime, REFRESH_RATE_SEC, JSContext
 from lab12 import Task, TaskRunner, SingleThreadedTaskRunner
@@ -47,25 +56,190 @@ from lab14 import parse_outline, paint_outline, \
     AccessibilityNode, PseudoclassSelector, SPEECH_FILE
 from lab14 import DocumentLayout, BlockLayout, LineLayout, TextLayout
 
-@wbetools.patch(URL)
-class URL:
-    def request(self, referrer, payload=None):
+class HTTPConnection:
+    def __init__(self, scheme, host, port):
+        self.key = (scheme, host, port)
         s = socket.socket(
             family=socket.AF_INET,
             type=socket.SOCK_STREAM,
             proto=socket.IPPROTO_TCP,
         )
-        s.connect((self.host, self.port))
-    
-        if self.scheme == "https":
+        s.connect((host, port))
+
+        if scheme == "https":
             ctx = ssl.create_default_context()
-            s = ctx.wrap_socket(s, server_hostname=self.host)
-    
+            s = ctx.wrap_socket(s, server_hostname=host)
+
+        self.socket = s
+        self.response = None
+        self.requests = 0
+        self.last_used = time.time()
+
+    def close(self):
+        if self.response:
+            self.response.close()
+        self.socket.close()
+
+    @wbetools.js_hide
+    def __repr__(self):
+        return "HTTPConnection(key={}, requests={})".format(
+            self.key, self.requests)
+
+class ConnectionPool:
+    MAX_PER_HOST = 6
+    IDLE_TIMEOUT_SEC = 30
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.idle = {}
+        self.in_use = {}
+
+    def acquire(self, scheme, host, port, fresh=False):
+        key = (scheme, host, port)
+        conn = None
+        self.condition.acquire(blocking=True)
+        while True:
+            self.close_expired(key)
+            idle = self.idle.get(key)
+            if idle and not fresh:
+                conn = idle.pop()
+                break
+            if self.in_use.get(key, 0) < self.MAX_PER_HOST:
+                break
+            self.condition.wait()
+        self.in_use[key] = self.in_use.get(key, 0) + 1
+        self.condition.release()
+
+        if not conn:
+            try:
+                conn = HTTPConnection(scheme, host, port)
+            except Exception:
+                self.release_slot(key)
+                raise
+        return conn
+
+    def release(self, conn, keep_alive):
+        if keep_alive:
+            conn.last_used = time.time()
+        else:
+            conn.close()
+        self.condition.acquire(blocking=True)
+        if keep_alive:
+            self.idle.setdefault(conn.key, []).append(conn)
+        self.in_use[conn.key] -= 1
+        self.condition.notify_all()
+        self.condition.release()
+
+    def release_slot(self, key):
+        self.condition.acquire(blocking=True)
+        self.in_use[key] -= 1
+        self.condition.notify_all()
+        self.condition.release()
+
+    def close_expired(self, key):
+        now = time.time()
+        idle = self.idle.get(key, [])
+        for conn in [conn for conn in idle
+                     if now - conn.last_used > self.IDLE_TIMEOUT_SEC]:
+            idle.remove(conn)
+            conn.close()
+
+    def close_all(self):
+        self.condition.acquire(blocking=True)
+        for conns in self.idle.values():
+            for conn in conns:
+                conn.close()
+        self.idle.clear()
+        self.condition.release()
+
+CONNECTION_POOL = ConnectionPool()
+
+READ_SIZE = 16384
+
+def read_chunked(response):
+    while True:
+        line = response.readline().decode("utf8").strip()
+        chunk_size = int(line.split(";", 1)[0], 16)
+        if chunk_size == 0: break
+        yield response.read(chunk_size)
+        response.readline()
+    while True:
+        line = response.readline()
+        if line in [b"\r\n", b""]: break
+
+NO_BODY_STATUSES = ["204", "304"]
+
+class ResponseBody:
+    def __init__(self, conn, method, statusline, response_headers):
+        self.conn = conn
+        self.headers = response_headers
+        version, status = statusline.split(" ", 2)[:2]
+        connection = response_headers.get("connection", "").casefold()
+        if version == "HTTP/1.1":
+            self.keep_alive = connection != "close"
+        else:
+            self.keep_alive = connection == "keep-alive"
+        self.empty = method == "HEAD" or status.startswith("1") or \
+            status in NO_BODY_STATUSES
+        self.done = False
+        self.released = False
+
+    def __iter__(self):
+        try:
+            if not self.empty:
+                yield from self.read()
+            self.done = True
+        finally:
+            self.close()
+
+    def read(self):
+        response = self.conn.response
+        transfer_encoding = \
+            self.headers.get("transfer-encoding", "").casefold()
+        if transfer_encoding == "chunked":
+            yield from read_chunked(response)
+        elif "content-length" in self.headers:
+            remaining = int(self.headers["content-length"])
+            while remaining > 0:
+                chunk = response.read1(min(remaining, READ_SIZE))
+                if not chunk:
+                    self.keep_alive = False
+                    break
+                remaining -= len(chunk)
+                yield chunk
+        else:
+            self.keep_alive = False
+            while True:
+                chunk = response.read1(READ_SIZE)
+                if not chunk: break
+                yield chunk
+
+    def close(self):
+        if self.released: return
+        self.released = True
+        CONNECTION_POOL.release(self.conn, self.keep_alive and self.done)
+
+    def __del__(self):
+        self.close()
+
+COOKIE_JAR_LOCK = threading.Lock()
+
+@wbetools.patch(URL)
+class URL:
+    def request(self, referrer, payload=None):
+        response_headers, chunks = self.stream(referrer, payload)
+        return response_headers, b"".join(chunks)
+
+    def stream(self, referrer, payload=None):
         method = "POST" if payload else "GET"
-        body = "{} {} HTTP/1.0\r\n".format(method, self.path)
+        body = "{} {} HTTP/1.1\r\n".format(method, self.path)
         body += "Host: {}\r\n".format(self.host)
-        if self.host in COOKIE_JAR:
-            cookie, params = COOKIE_JAR[self.host]
+        body += "Connection: keep-alive\r\n"
+        COOKIE_JAR_LOCK.acquire(blocking=True)
+        jar_entry = COOKIE_JAR.get(self.host)
+        COOKIE_JAR_LOCK.release()
+        if jar_entry:
+            cookie, params = jar_entry
             allow_cookie = True
             if referrer and params.get("samesite", "none") == "lax":
                 if method != "GET":
@@ -76,20 +250,47 @@ class URL:
             content_length = len(payload.encode("utf8"))
             body += "Content-Length: {}\r\n".format(content_length)
         body += "\r\n" + (payload or "")
-        s.send(body.encode("utf8"))
-    
-        response = s.makefile("b")
-    
-        statusline = response.readline().decode("utf8")
+
+        conn = CONNECTION_POOL.acquire(self.scheme, self.host, self.port)
+        try:
+            statusline = self.send_request(conn, body)
+            if not statusline and conn.requests > 0:
+                # The server closed an idle keep-alive connection
+                CONNECTION_POOL.release(conn, False)
+                conn = None
+                conn = CONNECTION_POOL.acquire(
+                    self.scheme, self.host, self.port, fresh=True)
+                statusline = self.send_request(conn, body)
+            conn.requests += 1
+            response_headers = \
+                self.read_response(conn.response, statusline)
+        except Exception:
+            if conn:
+                CONNECTION_POOL.release(conn, False)
+            raise
+        return response_headers, \
+            ResponseBody(conn, method, statusline, response_headers)
+
+    def send_request(self, conn, request):
+        try:
+            conn.socket.send(request.encode("utf8"))
+            if not conn.response:
+                conn.response = conn.socket.makefile("b")
+            return conn.response.readline().decode("utf8")
+        except OSError:
+            if conn.requests == 0: raise
+            return ""
+
+    def read_response(self, response, statusline):
         version, status, explanation = statusline.split(" ", 2)
-    
+
         response_headers = {}
         while True:
             line = response.readline().decode("utf8")
             if line == "\r\n": break
             header, value = line.split(":", 1)
             response_headers[header.casefold()] = value.strip()
-    
+
         if "set-cookie" in response_headers:
             cookie = response_headers["set-cookie"]
             params = {}
@@ -101,16 +302,121 @@ class URL:
                     else:
                         value = "true"
                     params[param.strip().casefold()] = value.casefold()
+            COOKIE_JAR_LOCK.acquire(blocking=True)
             COOKIE_JAR[self.host] = (cookie, params)
-    
-        assert "transfer-encoding" not in response_headers
+            COOKIE_JAR_LOCK.release()
+
         assert "content-encoding" not in response_headers
-    
-        body = response.read()
-        s.close()
-        return response_headers, body
-      
-DEFAULT_STYLE_SHEET = CSSParser(open("browser15.css").read()).parse()
+        return response_headers
+
+def encode_selector(selector):
+    if isinstance(selector, TagSelector):
+        return ["tag", selector.tag]
+    elif isinstance(selector, PseudoclassSelector):
+        base = encode_selector(selector.base)
+        return base and ["pseudoclass", selector.pseudoclass, base]
+    elif isinstance(selector, DescendantSelector):
+        ancestor = encode_selector(selector.ancestor)
+        descendant = encode_selector(selector.descendant)
+        return ancestor and descendant and \
+            ["descendant", ancestor, descendant]
+    return None
+
+def decode_selector(data):
+    if data[0] == "tag":
+        return TagSelector(data[1])
+    elif data[0] == "pseudoclass":
+        return PseudoclassSelector(data[1], decode_selector(data[2]))
+    elif data[0] == "descendant":
+        return DescendantSelector(
+            decode_selector(data[1]), decode_selector(data[2]))
+    raise ValueError("Unknown selector " + str(data[0]))
+
+STYLESHEET_CACHE_SIZE = 64
+
+class StylesheetCache:
+    FORMAT = "rules-v1"
+
+    def __init__(self, size=STYLESHEET_CACHE_SIZE,
+                 cache_dir="cached_data"):
+        self.lock = threading.Lock()
+        self.cache_dir = cache_dir
+        self.disk = None
+        self.size = size
+        self.rules = collections.OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def parse(self, text, persist=True):
+        key = "stylesheet:{}:{}".format(self.FORMAT,
+            hashlib.sha256(text.encode("utf8", "replace")).hexdigest())
+        self.lock.acquire(blocking=True)
+        rules = self.rules.get(key)
+        if rules is not None:
+            self.rules.move_to_end(key)
+            self.hits += 1
+        self.lock.release()
+        if rules is not None:
+            return rules
+
+        rules = self.load(key) if persist else None
+        from_disk = rules is not None
+        if not from_disk:
+            rules = CSSParser(text).parse()
+            if persist: self.save(key, rules)
+
+        self.lock.acquire(blocking=True)
+        if from_disk:
+            self.disk_hits += 1
+        else:
+            self.misses += 1
+        rules = self.rules.setdefault(key, rules)
+        while len(self.rules) > self.size:
+            self.rules.popitem(last=False)
+        self.lock.release()
+        return rules
+
+    def open_disk(self):
+        if not wbetools.PERSIST_STYLESHEETS or not self.cache_dir:
+            return None
+        if not self.disk:
+            self.disk = Cache(self.cache_dir)
+        return self.disk
+
+    def load(self, key):
+        try:
+            if not self.open_disk(): return None
+            data = self.disk.get(key)
+            if data is None: return None
+            return [(media, decode_selector(selector), body)
+                for media, selector, body in json.loads(data)]
+        except Exception:
+            return None
+
+    def save(self, key, rules):
+        encoded = []
+        for media, selector, body in rules:
+            data = encode_selector(selector)
+            if not data: return
+            encoded.append([media, data, body])
+        try:
+            if not self.open_disk(): return
+            self.disk.set(key,
+                json.dumps(encoded, separators=(",", ":")).encode("utf8"))
+        except OSError:
+            pass
+
+    @wbetools.js_hide
+    def __repr__(self):
+        return ("StylesheetCache(entries={}, hits={}, disk_hits={}, " +
+            "misses={})").format(
+            len(self.rules), self.hits, self.disk_hits, self.misses)
+
+STYLESHEET_CACHE = StylesheetCache()
+
+DEFAULT_STYLE_SHEET = STYLESHEET_CACHE.parse(
+    open("browser15.css").read(), persist=False)
 
 def parse_image_rendering(quality):
     if int(skia.__version__.split(".")[0]) > 87:
@@ -156,7 +462,7 @@ def paint_tree(layout_object, display_list):
 
     if isinstance(layout_object, IframeLayout) and \
         layout_object.node.frame and \
-        layout_object.node.frame.loaded:
+        layout_object.node.frame.renderable:
         paint_tree(layout_object.node.frame.document, cmds)
     else:
         for child in layout_object.children:
@@ -295,11 +601,11 @@ class BlockLayout:
             child = child_class(node, line, previous_word, frame)
         line.children.append(child)
         self.cursor_x += w + \
-            font(node.style, self.zoom).measureText(" ")
+            font_metrics(font(node.style, self.zoom)).space
 
     def word(self, node, word):
         node_font = font(node.style, self.zoom)
-        w = node_font.measureText(word)
+        w = measure_word(node_font, word)
         self.add_inline_child(node, w, TextLayout, self.frame, word)
 
     def input(self, node):
@@ -361,7 +667,7 @@ class EmbedLayout:
         self.zoom = self.parent.zoom
         self.font = font(self.node.style, self.zoom)
         if self.previous:
-            space = self.previous.font.measureText(" ")
+            space = font_metrics(self.previous.font).space
             self.x = \
                 self.previous.x + space + self.previous.width
         else:
@@ -468,18 +774,19 @@ class TextLayout:
         self.font = font(self.node.style, self.zoom)
 
         # Do not set self.y!!!
-        self.width = self.font.measureText(self.word)
+        self.width = measure_word(self.font, self.word)
 
         if self.previous:
-            space = self.previous.font.measureText(" ")
+            space = font_metrics(self.previous.font).space
             self.x =self.previous.x + space + self.previous.width
         else:
             self.x = self.parent.x
 
         self.height = linespace(self.font)
 
-        self.ascent = self.font.getMetrics().fAscent * 1.25
-        self.descent = self.font.getMetrics().fDescent * 1.25
+        metrics = font_metrics(self.font)
+        self.ascent = metrics.ascent * 1.25
+        self.descent = metrics.descent * 1.25
 
 class ImageLayout(EmbedLayout):
     def __init__(self, node, parent, previous, frame):
@@ -553,7 +860,7 @@ class IframeLayout(EmbedLayout):
         else:
             self.height = dpx(IFRAME_HEIGHT_PX + 2, self.zoom)
 
-        if self.node.frame and self.node.frame.loaded:
+        if self.node.frame and self.node.frame.renderable:
             self.node.frame.frame_height = \
                 self.height - dpx(2, self.zoom)
             self.node.frame.frame_width = \
@@ -602,42 +909,34 @@ class IframeLayout(EmbedLayout):
 
 @wbetools.outline_hide
 class AttributeParser:
+    WHITESPACE = re.compile(r"\s*")
+    WORD = re.compile(r"[^\s=\"']*")
+    QUOTED_WORD = re.compile(r"(?:[^\s=\"']+|[\"'][^\"']*[\"']?)*")
+
     def __init__(self, s):
         self.s = s
         self.i = 0
 
     def whitespace(self):
-        while self.i < len(self.s) and self.s[self.i].isspace():
-            self.i += 1
+        self.i = self.WHITESPACE.match(self.s, self.i).end()
 
     def literal(self, literal):
-        if self.i < len(self.s) and self.s[self.i] == literal:
+        if self.s.startswith(literal, self.i):
             self.i += 1
             return True
         return False
 
     def word(self, allow_quotes=False):
         start = self.i
-        in_quote = False
-        quoted = False
-        while self.i < len(self.s):
-            cur = self.s[self.i]
-            if not cur.isspace() and cur not in "=\"\'":
-                self.i += 1
-            elif allow_quotes and cur in "\"\'":
-                in_quote = not in_quote
-                quoted = True
-                self.i += 1
-            elif in_quote and (cur.isspace() or cur == "="):
-                self.i += 1
-            else:
-                break
+        pattern = self.QUOTED_WORD if allow_quotes else self.WORD
+        self.i = pattern.match(self.s, start).end()
         if self.i == start:
             self.i = len(self.s)
             return ""
-        if quoted:
-            return self.s[start+1:self.i-1]
-        return self.s[start:self.i]
+        word = self.s[start:self.i]
+        if allow_quotes and ("\"" in word or "'" in word):
+            return word[1:-1]
+        return word
 
     def parse(self):
         attributes = {}
@@ -842,30 +1141,35 @@ class JSContext:
 def style(node, rules, frame):
     old_style = node.style
 
-    node.style = {}
-    for property, default_value in INHERITED_PROPERTIES.items():
-        if node.parent:
-            node.style[property] = node.parent.style[property]
-        else:
-            node.style[property] = default_value
-    for media, selector, body in rules:
-        if media:
-            if (media == "dark") != frame.tab.dark_mode: continue
-        if not selector.matches(node): continue
-        for property, value in body.items():
-            node.style[property] = value
-    if isinstance(node, Element) and "style" in node.attributes:
-        pairs = CSSParser(node.attributes["style"]).body()
-        for property, value in pairs.items():
-            node.style[property] = value
-    if node.style["font-size"].endswith("%"):
-        if node.parent:
-            parent_font_size = node.parent.style["font-size"]
-        else:
-            parent_font_size = INHERITED_PROPERTIES["font-size"]
-        node_pct = float(node.style["font-size"][:-1]) / 100
-        parent_px = float(parent_font_size[:-2])
-        node.style["font-size"] = str(node_pct * parent_px) + "px"
+    key, shared = rules.lookup_style(node)
+    if shared:
+        node.style = shared.copy()
+    else:
+        node.style = {}
+        for property, default_value in INHERITED_PROPERTIES.items():
+            if node.parent:
+                node.style[property] = node.parent.style[property]
+            else:
+                node.style[property] = default_value
+        for media, selector, body in rules.candidates(node):
+            if media:
+                if (media == "dark") != frame.tab.dark_mode: continue
+            if not selector.matches(node): continue
+            for property, value in body.items():
+                node.style[property] = value
+        if isinstance(node, Element) and "style" in node.attributes:
+            pairs = parse_inline_style(node.attributes["style"])
+            for property, value in pairs.items():
+                node.style[property] = value
+        if node.style["font-size"].endswith("%"):
+            if node.parent:
+                parent_font_size = node.parent.style["font-size"]
+            else:
+                parent_font_size = INHERITED_PROPERTIES["font-size"]
+            node_pct = float(node.style["font-size"][:-1]) / 100
+            parent_px = float(parent_font_size[:-2])
+            node.style["font-size"] = str(node_pct * parent_px) + "px"
+        rules.store_style(node, key, node.style.copy())
 
     if old_style:
         transitions = diff_styles(old_style, node.style)
@@ -878,8 +1182,12 @@ def style(node, rules, frame):
                 node.animations[property] = animation
                 node.style[property] = animation.animate()
 
-    for child in node.children:
-        style(child, rules, frame)
+    rules.push_ancestor(node)
+    try:
+        for child in node.children:
+            style(child, rules, frame)
+    finally:
+        rules.pop_ancestor()
 
 @wbetools.patch(AccessibilityNode)
 class AccessibilityNode:
@@ -956,7 +1264,7 @@ class AccessibilityNode:
     def build_internal(self, child_node):
         if isinstance(child_node, Element) \
             and child_node.tag == "iframe" and child_node.frame \
-            and child_node.frame.loaded:
+            and child_node.frame.renderable:
             child = FrameAccessibilityNode(child_node, self)
         else:
             child = AccessibilityNode(child_node, self)
@@ -1016,6 +1324,73 @@ class FrameAccessibilityNode(AccessibilityNode):
 
 
 BROKEN_IMAGE = skia.Image.open("Broken_Image.png")
+PENDING_IMAGE = skia.Image.MakeRasterData(
+    skia.ImageInfo.MakeN32Premul(1, 1), bytes(4), 4)
+
+PRIORITY_STYLE = 0
+PRIORITY_SCRIPT = 0
+PRIORITY_DOCUMENT = 1
+PRIORITY_IMAGE = 2
+
+PARTIAL_RENDER_INTERVAL_SEC = 0.1
+
+class ResourceLoader:
+    NUM_WORKERS = 6
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.queue = []
+        self.count = 0
+        self.workers = []
+
+    def fetch(self, task_runner, priority, url, referrer, callback, *args):
+        self.condition.acquire(blocking=True)
+        heapq.heappush(self.queue, (priority, self.count,
+            task_runner, url, referrer, callback, args))
+        self.count += 1
+        if len(self.workers) < self.NUM_WORKERS:
+            worker = threading.Thread(
+                target=self.run,
+                name="Loader thread {}".format(len(self.workers)),
+                daemon=True,
+            )
+            self.workers.append(worker)
+            worker.start()
+        self.condition.notify()
+        self.condition.release()
+
+    def run(self):
+        while True:
+            self.condition.acquire(blocking=True)
+            while not self.queue:
+                self.condition.wait()
+            (priority, count, task_runner, url, referrer,
+                callback, args) = heapq.heappop(self.queue)
+            self.condition.release()
+
+            try:
+                response = url.request(referrer)
+            except Exception as e:
+                print("Load of", url, "failed", e)
+                response = None
+            task_runner.schedule_task(Task(callback, *args, response))
+
+RESOURCE_LOADER = ResourceLoader()
+
+def decode_image(img, response):
+    try:
+        assert response, "Load failed"
+        header, body = response
+        img.encoded_data = body
+        data = skia.Data.MakeWithoutCopy(body)
+        img.image = skia.Image.MakeFromEncoded(data)
+        assert img.image, \
+            "Failed to recognize image format for " + \
+            img.attributes.get("src", "")
+    except Exception as e:
+        print("Image", img.attributes.get("src", ""),
+            "crashed", e)
+        img.image = BROKEN_IMAGE
 
 class Frame:
     def __init__(self, tab, parent_frame, frame_element):
@@ -1033,6 +1408,10 @@ class Frame:
         self.url = None
         self.js = None
         self.loaded = False
+        self.renderable = False
+        self.load_id = 0
+        self.rule_index = None
+        self.rules_changed = False
 
         self.frame_width = 0
         self.frame_height = 0
@@ -1055,12 +1434,20 @@ class Frame:
             url.origin() in self.allowed_origins
 
     def load(self, url, payload=None):
+        headers, chunks = url.stream(self.url, payload)
+        self.load_stream(url, headers, chunks)
+
+    def load_response(self, url, response):
+        if not response: return
+        headers, body = response
+        self.load_stream(url, headers, [body])
+
+    def load_stream(self, url, headers, chunks):
         self.loaded = False
+        self.renderable = False
         self.zoom = 1
         self.scroll = 0
         self.scroll_changed_in_frame = True
-        headers, body = url.request(self.url, payload)
-        body = body.decode("utf8", "replace")
         self.url = url
 
         self.allowed_origins = None
@@ -1069,73 +1456,99 @@ class Frame:
            if len(csp) > 0 and csp[0] == "default-src":
                self.allowed_origins = csp[1:]
 
-        self.nodes = HTMLParser(body).parse()
-
         if self.js: self.js.discarded = True
         self.js = self.tab.get_js(url)
         self.js.add_window(self)
 
-        scripts = [node.attributes["src"] for node
-                   in tree_to_list(self.nodes, [])
-                   if isinstance(node, Element)
-                   and node.tag == "script"
-                   and "src" in node.attributes]
-        for script in scripts:
-            script_url = url.resolve(script)
-            if not self.allowed_request(script_url):
-                print("Blocked script", script, "due to CSP")
-                continue
-
-            try:
-                header, body = script_url.request(url)
-            except:
-                continue
-            body = body.decode("utf8", "replace")
-            task = Task(self.js.run, script_url, body,
-                self.window_id)
-            self.tab.task_runner.schedule_task(task)
-
         self.rules = DEFAULT_STYLE_SHEET.copy()
-        links = [node.attributes["href"]
-                 for node in tree_to_list(self.nodes, [])
-                 if isinstance(node, Element)
-                 and node.tag == "link"
-                 and node.attributes.get("rel") == "stylesheet"
-                 and "href" in node.attributes]
-        for link in links:  
-            style_url = url.resolve(link)
-            if not self.allowed_request(style_url):
-                print("Blocked style", link, "due to CSP")
-                continue
-            try:
-                header, body = style_url.request(url)
-            except:
-                continue
-            self.rules.extend(CSSParser(body.decode("utf8", "replace")).parse())
+        self.rule_index = None
+        self.rules_changed = False
+        parser = HTMLParser()
+        decoder = codecs.getincrementaldecoder("utf8")("replace")
+        next_render = time.time() + PARTIAL_RENDER_INTERVAL_SEC
+        for chunk in chunks:
+            parser.feed(decoder.decode(chunk))
+            if time.time() >= next_render:
+                start = time.time()
+                self.render_partial(parser)
+                elapsed = time.time() - start
+                next_render = time.time() + \
+                    max(PARTIAL_RENDER_INTERVAL_SEC, 4 * elapsed)
+        parser.feed(decoder.decode(b"", True))
+        self.nodes = parser.finish()
+
+        self.load_subresources(url)
+
+        self.renderable = True
+        self.set_needs_render()
+        self.check_loaded()
+
+    def render_partial(self, parser):
+        self.nodes = parser.partial_tree()
+        if not self.nodes or not self.frame_width: return
+        self.renderable = True
+        self.set_needs_render()
+        if self != self.tab.root_frame: return
+        self.tab.run_animation_frame(self.tab.root_frame.scroll)
+
+    def fetch(self, priority, url, referrer, callback, *args):
+        load_id = self.load_id
+        def on_load(*args):
+            if load_id != self.load_id: return
+            callback(*args)
+        RESOURCE_LOADER.fetch(self.tab.task_runner, priority,
+            url, referrer, on_load, *args)
+
+    def load_subresources(self, url):
+        self.load_id += 1
+        nodes = tree_to_list(self.nodes, [])
+
+        self.links = []
+        self.scripts = []
+        for node in nodes:
+            if not isinstance(node, Element): continue
+            if node.tag == "link" and \
+                node.attributes.get("rel") == "stylesheet" and \
+                "href" in node.attributes:
+                link = node.attributes["href"]
+                style_url = url.resolve(link)
+                if not self.allowed_request(style_url):
+                    print("Blocked style", link, "due to CSP")
+                    continue
+                slot = [None, False]
+                self.links.append(slot)
+                self.fetch(PRIORITY_STYLE, style_url, url,
+                    self.style_loaded, slot)
+            elif node.tag == "script" and "src" in node.attributes:
+                script = node.attributes["src"]
+                script_url = url.resolve(script)
+                if not self.allowed_request(script_url):
+                    print("Blocked script", script, "due to CSP")
+                    continue
+                # Scripts wait for the stylesheets that precede them
+                slot = [script_url, None, False, list(self.links)]
+                self.scripts.append(slot)
+                self.fetch(PRIORITY_SCRIPT, script_url, url,
+                    self.script_loaded, slot)
 
         images = [node
-            for node in tree_to_list(self.nodes, [])
+            for node in nodes
             if isinstance(node, Element)
             and node.tag == "img"]
         for img in images:
-            try:
-                src = img.attributes.get("src", "")
-                image_url = url.resolve(src)
-                assert self.allowed_request(image_url), \
-                    "Blocked load of " + str(image_url) + " due to CSP"
-                header, body = image_url.request(url)
-                img.encoded_data = body
-                data = skia.Data.MakeWithoutCopy(body)
-                img.image = skia.Image.MakeFromEncoded(data)
-                assert img.image, \
-                    "Failed to recognize image format for " + str(image_url)
-            except Exception as e:
-                print("Image", img.attributes.get("src", ""),
-                    "crashed", e)
+            img.image = PENDING_IMAGE
+            src = img.attributes.get("src", "")
+            image_url = url.resolve(src)
+            if not self.allowed_request(image_url):
+                print("Image", src, "crashed",
+                    "Blocked load of " + str(image_url) + " due to CSP")
                 img.image = BROKEN_IMAGE
+                continue
+            self.fetch(PRIORITY_IMAGE, image_url, url,
+                self.image_loaded, img)
 
         iframes = [node
-                   for node in tree_to_list(self.nodes, [])
+                   for node in nodes
                    if isinstance(node, Element)
                    and node.tag == "iframe"
                    and "src" in node.attributes]
@@ -1146,11 +1559,50 @@ class Frame:
                 iframe.frame = None
                 continue
             iframe.frame = Frame(self.tab, self, iframe)
-            task = Task(iframe.frame.load, document_url)
-            self.tab.task_runner.schedule_task(task)
+            self.fetch(PRIORITY_DOCUMENT, document_url, url,
+                iframe.frame.load_response, document_url)
+
+    def style_loaded(self, slot, response):
+        if response:
+            header, body = response
+            slot[0] = STYLESHEET_CACHE.parse(
+                body.decode("utf8", "replace"))
+            self.rules_changed = True
+            self.set_needs_render()
+        slot[1] = True
+        self.run_ready_scripts()
 
-        self.set_needs_render()
-        self.loaded = True
+    def update_rules(self):
+        self.rules = DEFAULT_STYLE_SHEET.copy()
+        for rules, done in self.links:
+            if rules: self.rules.extend(rules)
+        self.rule_index = None
+        self.rules_changed = False
+
+    def script_loaded(self, slot, response):
+        if response:
+            header, body = response
+            slot[1] = body.decode("utf8", "replace")
+        slot[2] = True
+        self.run_ready_scripts()
+
+    def run_ready_scripts(self):
+        while self.scripts and self.scripts[0][2] and \
+            all([done for rules, done in self.scripts[0][3]]):
+            script_url, body, done, links = self.scripts.pop(0)
+            if body != None:
+                self.js.run(script_url, body, self.window_id)
+        self.check_loaded()
+
+    def check_loaded(self):
+        if self.loaded or self.scripts: return
+        if all([done for rules, done in self.links]):
+            self.loaded = True
+            self.set_needs_render()
+
+    def image_loaded(self, img, response):
+        decode_image(img, response)
+        self.set_needs_layout()
 
     def render(self):
         if self.needs_style:
@@ -1158,9 +1610,12 @@ class Frame:
                 INHERITED_PROPERTIES["color"] = "white"
             else:
                 INHERITED_PROPERTIES["color"] = "black"
-            style(self.nodes,
-                  sorted(self.rules,
-                         key=cascade_priority), self)
+            if self.rules_changed:
+                self.update_rules()
+            if not self.rule_index:
+                self.rule_index = RuleIndex(
+                    sorted(self.rules, key=cascade_priority))
+            style(self.nodes, self.rule_index, self)
             self.needs_layout = True
             self.needs_style = False
 
@@ -1356,9 +1811,9 @@ class Tab:
         self.history.append(url)
         self.task_runner.clear_pending_tasks()
         self.root_frame = Frame(self, None, None)
-        self.root_frame.load(url, payload)
         self.root_frame.frame_width = WIDTH
         self.root_frame.frame_height = self.tab_height
+        self.root_frame.load(url, payload)
         self.loaded = True
 
     def get_js(self, url):
@@ -1389,12 +1844,13 @@ class Tab:
 
         needs_composite = False
         for (window_id, frame) in self.window_id_to_frame.items():
-            if not frame.loaded:
+            if not frame.renderable:
                 continue
 
-            self.browser.measure.time('script-runRAFHandlers')
-            frame.js.dispatch_RAF(frame.window_id)
-            self.browser.measure.stop('script-runRAFHandlers')
+            if frame.loaded:
+                self.browser.measure.time('script-runRAFHandlers')
+                frame.js.dispatch_RAF(frame.window_id)
+                self.browser.measure.stop('script-runRAFHandlers')
 
             for node in tree_to_list(frame.nodes, []):
                 for (property_name, animation) in \
@@ -1453,7 +1909,7 @@ class Tab:
         self.browser.measure.time('render')
 
         for id, frame in self.window_id_to_frame.items():
-            if frame.loaded:
+            if frame.renderable:
                 frame.render()
 
         if self.needs_accessibility:
@@ -7,6 +7,7 @@ without exercises.
 import sys
 import sdl2
 import skia
+import codecs
 import ctypes
 import math
 import OpenGL.GL
@@ -15,17 +16,24 @@ import socket
 import ssl
 import dukpy
 import time
+import itertools
 import wbetools
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from lab2 import WIDTH, HEIGHT, HSTEP, VSTEP, SCROLL_STEP
 from lab4 import print_tree
 from lab5 import BLOCK_ELEMENTS
 from lab14 import Text, Element
 from lab6 import TagSelector, DescendantSelector
-from lab6 import tree_to_list, INHERITED_PROPERTIES
+from lab6 import tree_to_list, INHERITED_PROPERTIES, RuleIndex
+from lab6 import parse_inline_style, node_classes
 from lab8 import INPUT_WIDTH_PX
 from lab10 import COOKIE_JAR
-from lab11 import FONTS, NAMED_COLORS, get_font, linespace
+from lab11 import FONTS, NAMED_COLORS, get_font, linespace, font_metrics
+from lab11 import measure_word, WORD_WIDTHS
 from lab11 import parse_color, parse_blend_mode
 from lab12 import MeasureTime, REFRESH_RATE_SEC, SETTIMEOUT_JS, XHR_ONLOAD_JS
 from lab12 import Task, TaskRunner, SingleThreadedTaskRunner
@@ -45,12 +53,18 @@ from lab15 import URL, HTMLParser, AttributeParser, DrawImage, \
     DocumentLayout, BlockLayout, \
     EmbedLayout, InputLayout, LineLayout, TextLayout, ImageLayout, \
     IframeLayout, JSContext, AccessibilityNode, FrameAccessibilityNode, Frame, Tab, \
-    CommitData, Browser, BROKEN_IMAGE, font, \
+    CommitData, Browser, BROKEN_IMAGE, decode_image, font, \
+    PARTIAL_RENDER_INTERVAL_SEC, STYLESHEET_CACHE, \
     IFRAME_WIDTH_PX, IFRAME_HEIGHT_PX, parse_image_rendering, DEFAULT_STYLE_SHEET, \
     EVENT_DISPATCH_JS, RUNTIME_JS, POST_MESSAGE_DISPATCH_JS
 
 
 class ProtectedField:
+    __slots__ = [
+        "obj", "name", "parent", "value", "dirty", "invalidations",
+        "frozen_dependencies", "frozen_invalidations",
+    ]
+
     def __init__(self, obj, name, parent=None, dependencies=None,
         invalidations=None):
         self.obj = obj
@@ -59,11 +73,15 @@ class ProtectedField:
 
         self.value = None
         self.dirty = True
-        self.invalidations = set()
+        # Most fields are never read, so the list is created lazily
+        self.invalidations = None
         self.frozen_dependencies = (dependencies != None)
         if dependencies != None:
             for dependency in dependencies:
-                dependency.invalidations.add(self)
+                if dependency.invalidations == None:
+                    dependency.invalidations = [self]
+                else:
+                    dependency.invalidations.append(self)
         else:
             assert \
                 self.name in [
@@ -74,14 +92,25 @@ class ProtectedField:
         if invalidations != None:
             assert self.name == "children"
             for invalidation in invalidations:
-                self.invalidations.add(invalidation)
+                self.add_invalidation(invalidation)
+
+    def add_invalidation(self, field):
+        if self.invalidations == None:
+            self.invalidations = [field]
+        elif field not in self.invalidations:
+            self.invalidations.append(field)
 
     def set_dependencies(self, dependencies):
         assert self.name in ["height", "ascent", "descent"] or \
             self.name in CSS_PROPERTIES
         assert self.name == "height" or not self.frozen_dependencies
         for dependency in dependencies:
-            dependency.invalidations.add(self)
+            if self.frozen_dependencies:
+                dependency.add_invalidation(self)
+            elif dependency.invalidations == None:
+                dependency.invalidations = [self]
+            else:
+                dependency.invalidations.append(self)
         self.frozen_dependencies = True
 
     def set_ancestor_dirty_bits(self):
@@ -96,8 +125,11 @@ class ProtectedField:
         self.set_ancestor_dirty_bits()
 
     def notify(self):
-        for field in self.invalidations:
-            field.mark()
+        if self.invalidations:
+            for field in self.invalidations:
+                if not field.dirty:
+                    field.dirty = True
+                    field.set_ancestor_dirty_bits()
         self.set_ancestor_dirty_bits()
 
     def set(self, value):
@@ -114,10 +146,20 @@ class ProtectedField:
 
     @wbetools.named_params
     def read(self, notify):
+        if wbetools.ASSERT_LAYOUT_CLEAN or \
+            wbetools.PRINT_INVALIDATION_DEPENDENCIES:
+            return self.checked_read(notify)
+        if not notify.frozen_dependencies and \
+            not self.frozen_invalidations:
+            self.add_invalidation(notify)
+        assert not self.dirty
+        return self.value
+
+    def checked_read(self, notify):
         if notify.frozen_dependencies or self.frozen_invalidations:
-            assert notify in self.invalidations
+            assert self.invalidations and notify in self.invalidations
         else:
-            self.invalidations.add(notify)
+            self.add_invalidation(notify)
 
         if wbetools.PRINT_INVALIDATION_DEPENDENCIES:
             prefix = ""
@@ -150,6 +192,18 @@ class ProtectedField:
             self.obj.node if hasattr(self.obj, "node") else self.obj,
             self.name)
 
+class PaintCache(ProtectedField):
+    __slots__ = []
+
+    def set_ancestor_dirty_bits(self):
+        parent = self.parent
+        while parent:
+            cache = parent.paint_cache
+            if cache:
+                if cache.dirty: break
+                cache.dirty = True
+            parent = parent.parent
+
 @wbetools.patch(is_focusable)
 def is_focusable(node):
     if get_tabindex(node) <= 0:
@@ -200,6 +254,62 @@ def font(css_style, zoom, notify):
     font_size = dpx(size, zoom)
     return get_font(font_size, weight, style)
 
+TEXT_RUN_MIN_WORDS = 32
+LAZY_LAYOUT_MARGIN = HEIGHT
+
+def measure_words(font, text, words):
+    key = font_metrics(font).key
+    if not numpy or key is None or len(words) < TEXT_RUN_MIN_WORDS:
+        return [measure_word(font, word) for word in words]
+    widths = WORD_WIDTHS.lookup(key, words)
+    missing = widths.count(None)
+    if missing < TEXT_RUN_MIN_WORDS:
+        if missing:
+            widths = [measure_word(font, word) if width is None else width
+                for word, width in zip(words, widths)]
+        return widths
+    glyphs = font.textToGlyphs(text)
+    if len(glyphs) != len(text):
+        return [measure_word(font, word) if width is None else width
+            for word, width in zip(words, widths)]
+    advances = numpy.zeros(len(text) + 1)
+    advances[:-1] = font.getWidths(glyphs)
+    bounds = []
+    end = 0
+    for word in words:
+        start = text.find(word, end)
+        end = start + len(word)
+        bounds.append(start)
+        bounds.append(end)
+    widths = numpy.add.reduceat(advances, bounds)[::2].tolist()
+    WORD_WIDTHS.update(key, words, widths, missing)
+    return widths
+
+def break_lines(widths, space, cursor_x, width):
+    if not numpy or len(widths) < TEXT_RUN_MIN_WORDS:
+        for i, w in enumerate(widths):
+            if cursor_x + w > width:
+                yield i, 0
+                cursor_x = 0
+            cursor_x += w + space
+        yield len(widths), cursor_x
+        return
+    widths = numpy.asarray(widths)
+    ends = numpy.cumsum(widths + space)
+    rights = ends - space
+    start = 0
+    base = 0.0
+    while start < len(widths):
+        i = int(numpy.searchsorted(
+            rights, width - cursor_x + base, side="right"))
+        i = max(i, start)
+        if i >= len(widths): break
+        yield i, 0
+        cursor_x = widths[i] + space
+        base = ends[i]
+        start = i + 1
+    yield len(widths), float(cursor_x + ends[-1] - base)
+
 @wbetools.patch(absolute_bounds_for_obj)
 def absolute_bounds_for_obj(obj):
     rect = skia.Rect.MakeXYWH(
@@ -227,6 +337,67 @@ def paint_visual_effects(node, cmds, rect):
     blend_op = Blend(opacity, blend_mode, node, cmds)
     node.blend_op = blend_op
     return [Transform(translation, rect, node, [blend_op])]
+
+@wbetools.patch(VisualEffect)
+class VisualEffect:
+    def __init__(self, rect, children, node=None):
+        self.rect = rect.makeOffset(0.0, 0.0)
+        self.children = children
+        for child in self.children:
+            self.rect.join(child.rect)
+        self.node = node
+        self.needs_compositing = any([
+            child.needs_compositing for child in self.children
+            if isinstance(child, VisualEffect)
+        ])
+        self.optimized = None
+
+@wbetools.patch(DrawText)
+class DrawText:
+    def __init__(self, x1, y1, text, font, color, width=None):
+        if width == None:
+            width = font.measureText(text)
+        self.font = font
+        self.text = text
+        self.color = color
+        PaintCommand.__init__(self, skia.Rect.MakeLTRB(
+            x1, y1, x1 + width, y1 + font_metrics(font).linespace))
+
+class DrawTextBlob(PaintCommand):
+    def __init__(self, texts, font, color):
+        rect = skia.Rect.MakeEmpty()
+        for text in texts:
+            rect.join(text.rect)
+        super().__init__(rect)
+        self.runs = [(text.rect.left(), text.text) for text in texts]
+        self.font = font
+        self.color = color
+        self.blob = None
+
+    def execute(self, canvas):
+        if not self.blob:
+            glyphs = []
+            positions = []
+            for x, text in self.runs:
+                run_glyphs = self.font.textToGlyphs(text)
+                for width in self.font.getWidths(run_glyphs):
+                    positions.append(x)
+                    x += width
+                glyphs.extend(run_glyphs)
+            builder = skia.TextBlobBuilder()
+            builder.allocRunPosH(self.font, glyphs, positions, 0)
+            self.blob = builder.make()
+        paint = skia.Paint(
+            AntiAlias=True,
+            Color=parse_color(self.color)
+        )
+        baseline = self.rect.top() - font_metrics(self.font).ascent
+        canvas.drawTextBlob(self.blob, 0, baseline, paint)
+
+    @wbetools.js_hide
+    def __repr__(self):
+        return "DrawTextBlob(text={})".format(
+            " ".join([text for x, text in self.runs]))
     
 CSS_PROPERTIES = {
     "font-size": "inherit", "font-weight": "inherit",
@@ -248,6 +419,7 @@ class Element:
 
         self.style = None
         self.animations = {}
+        self.has_dirty_descendants = True
 
         self.is_focused = False
         self.layout_object = None
@@ -261,6 +433,7 @@ class Text:
 
         self.style = None
         self.animations = {}
+        self.has_dirty_descendants = True
 
         self.is_focused = False
         self.layout_object = None
@@ -280,6 +453,7 @@ class DocumentLayout:
         self.x = ProtectedField(self, "x", None, [])
         self.y = ProtectedField(self, "y", None, [])
         self.height = ProtectedField(self, "height")
+        self.paint_cache = None
 
         self.has_dirty_descendants = True
 
@@ -325,6 +499,9 @@ class DocumentLayout:
             cmds = [Transform((0, - self.frame.scroll), rect, self.node, cmds)]
         return cmds
 
+    def paint_dependencies(self):
+        return None
+
 @wbetools.patch(BlockLayout)
 class BlockLayout:
     def __init__(self, node, parent, previous, frame):
@@ -350,6 +527,9 @@ class BlockLayout:
 
         self.children = ProtectedField(self, "children", self.parent, None,
             [])
+        self.items = None
+        self.deferred = False
+        self.paint_cache = None
 
         self.has_dirty_descendants = True
 
@@ -378,7 +558,12 @@ class BlockLayout:
             self.y.copy(self.parent.y)
 
         mode = self.layout_mode()
-        if mode == "block":
+        if self.children.dirty:
+            self.deferred = self.should_defer()
+        if self.deferred:
+            if self.children.dirty:
+                self.defer()
+        elif mode == "block":
             if self.children.dirty:
                 children = []
                 previous = None
@@ -388,6 +573,7 @@ class BlockLayout:
                     children.append(next)
                     previous = next
                 self.children.set(children)
+                self.items = None
 
                 height_dependencies = \
                    [child.height for child in children]
@@ -395,9 +581,13 @@ class BlockLayout:
                 self.height.set_dependencies(height_dependencies)
         else:
             if self.children.dirty:
-                self.temp_children = []
-                self.new_line()
+                old_items = self.items
+                self.items = []
+                self.item_widths = []
+                self.run_ends = []
                 self.recurse(self.node)
+                self.temp_children = []
+                self.rebreak(old_items)
                 self.children.set(self.temp_children)
 
                 height_dependencies = \
@@ -405,12 +595,18 @@ class BlockLayout:
                 height_dependencies.append(self.children)
                 self.height.set_dependencies(height_dependencies)
                 self.temp_children = None
+                self.old_lines = None
+                self.tail = None
 
         for child in self.children.get():
             child.layout()
 
         self.has_dirty_descendants = False
 
+        if self.deferred:
+            self.height.set(self.estimated_height)
+            return
+
         children = self.children.read(notify=self.height)
         new_height = sum([
             child.height.read(notify=self.height)
@@ -418,6 +614,28 @@ class BlockLayout:
         ])
         self.height.set(new_height)
 
+    def should_defer(self):
+        if not wbetools.LAZY_LAYOUT: return False
+        if not isinstance(self.parent, BlockLayout): return False
+        bottom = self.frame.scroll + self.frame.frame_height + \
+            LAZY_LAYOUT_MARGIN
+        return self.y.get() > bottom
+
+    def defer(self):
+        zoom = self.zoom.read(notify=self.children)
+        width = max(1, self.width.read(notify=self.children))
+        node_font = font(self.node.style, zoom, notify=self.children)
+        char_width = measure_word(node_font, "x")
+        lines = 0
+        for node in tree_to_list(self.node, [])[1:]:
+            node.layout_object = None
+            if isinstance(node, Text):
+                lines += math.ceil(len(node.text) * char_width / width)
+        self.estimated_height = lines * linespace(node_font) * 1.25
+        self.items = None
+        self.children.set([])
+        self.height.set_dependencies([self.children])
+
     def input(self, node):
         zoom = self.zoom.read(notify=self.children)
         w = dpx(INPUT_WIDTH_PX, zoom)
@@ -439,35 +657,164 @@ class BlockLayout:
             w = IFRAME_WIDTH_PX + dpx(2, zoom)
         self.add_inline_child(node, w, IframeLayout, self.frame)
 
-    def word(self, node, word):
+    def recurse(self, node):
+        if isinstance(node, Text):
+            self.text(node)
+        else:
+            if node.tag == "br":
+                self.items.append((node, None, None, None, None))
+                self.item_widths.append(None)
+                self.run_ends.append(len(self.items))
+            elif node.tag == "input" or node.tag == "button":
+                self.input(node)
+            elif node.tag == "img":
+                self.image(node)
+            elif node.tag == "iframe" and \
+                 "src" in node.attributes:
+                self.iframe(node)
+            else:
+                for child in node.children:
+                    self.recurse(child)
+
+    def text(self, node):
+        words = node.text.split()
+        if not words: return
+        zoom = self.zoom.read(notify=self.children)
+        node_font = font(node.style, zoom, notify=self.children)
+        widths = measure_words(node_font, node.text, words)
+        space = font_metrics(node_font).space
+        end = len(self.items) + len(words)
+        self.items.extend(zip(itertools.repeat(node), words, widths,
+            itertools.repeat(space), itertools.repeat(TextRunLayout)))
+        self.item_widths.extend(widths)
+        self.run_ends.extend(itertools.repeat(end, len(words)))
+
+    def add_inline_child(self, node, w, child_class,
+                         frame, word=None):
         zoom = self.zoom.read(notify=self.children)
         node_font = font(node.style, zoom, notify=self.children)
-        w = node_font.measureText(word)
-        self.add_inline_child(
-            node, w, TextLayout, self.frame, word)
+        self.items.append(
+            (node, word, w, font_metrics(node_font).space, child_class))
+        self.item_widths.append(w)
+        self.run_ends.append(len(self.items))
+
+    def rebreak(self, old_items):
+        items = self.items
+        width = self.width.read(notify=self.children)
+        old_lines = self.children.value
+        if old_items == None or width != self.items_width:
+            old_items = []
+            old_lines = []
+        self.items_width = width
+
+        limit = min(len(items), len(old_items))
+        prefix = 0
+        while prefix < limit and items[prefix] == old_items[prefix]:
+            prefix += 1
+        if prefix == len(items) == len(old_items) and old_lines:
+            self.temp_children = old_lines
+            return
+        suffix = 0
+        while suffix < limit - prefix and \
+            items[-1 - suffix] == old_items[-1 - suffix]:
+            suffix += 1
+
+        for line in old_lines:
+            if line.end >= prefix: break
+            self.temp_children.append(line)
+        if len(self.temp_children) < len(old_lines):
+            first = old_lines[len(self.temp_children)]
+            start, forced = first.start, first.forced
+        else:
+            start, forced = 0, False
+
+        self.old_lines = old_lines
+        self.shift = len(old_items) - len(items)
+        self.tail = {}
+        for i in range(len(self.temp_children), len(old_lines)):
+            line = old_lines[i]
+            if line.start >= len(old_items) - suffix:
+                self.tail[(line.start - self.shift, line.forced)] = i
+
+        if self.new_line(start, forced): return
+        skip_check = forced
+        i = start
+        while i < len(items):
+            node, word, w, space, child_class = items[i]
+            if not child_class:
+                self.temp_children[-1].end = i
+                i += 1
+                if self.new_line(i, False): return
+                skip_check = False
+                continue
+            if skip_check or child_class != TextRunLayout:
+                if not skip_check and self.cursor_x + w > width:
+                    self.temp_children[-1].end = i
+                    if self.new_line(i, True): return
+                self.place(i, i + 1)
+                self.cursor_x += w + space
+                skip_check = False
+                i += 1
+                continue
+            end = self.run_ends[i]
+            last = i
+            for k, cursor_x in break_lines(self.item_widths[i:end],
+                space, self.cursor_x, width):
+                self.place(last, i + k)
+                if i + k == end:
+                    self.cursor_x = cursor_x
+                    break
+                self.temp_children[-1].end = i + k
+                if self.new_line(i + k, True): return
+                last = i + k
+            i = end
+        self.temp_children[-1].end = len(items)
+
+    def new_line(self, start=0, forced=False):
+        if (start, forced) in self.tail:
+            lines = self.old_lines[self.tail[(start, forced)]:]
+            previous = self.temp_children[-1] \
+                if self.temp_children else None
+            first = lines[0]
+            if first.previous is not previous:
+                first.previous = previous
+                if previous:
+                    previous.y.add_invalidation(first.y)
+                    previous.height.add_invalidation(first.y)
+                else:
+                    self.y.add_invalidation(first.y)
+                first.y.mark()
+            for line in lines:
+                line.start -= self.shift
+                line.end -= self.shift
+            self.temp_children.extend(lines)
+            return True
 
-    def new_line(self):
         self.previous_word = None
         self.cursor_x = 0
         last_line = self.temp_children[-1] \
             if self.temp_children else None
         new_line = LineLayout(self.node, self, last_line)
+        new_line.start = start
+        new_line.forced = forced
         self.temp_children.append(new_line)
+        return False
 
-    def add_inline_child(self, node, w, child_class,
-                         frame, word=None):
-        width = self.width.read(notify=self.children)
-        if self.cursor_x + w > width:
-            self.new_line()
+    def place(self, start, end):
         line = self.temp_children[-1]
-        if word:
-            child = child_class(node, word, line, self.previous_word)
-        else:
-            child = child_class(node, line, self.previous_word, frame)
-        line.children.append(child)
-        self.previous_word = child
-        zoom = self.zoom.read(notify=self.children)
-        self.cursor_x += w + font(node.style, zoom, notify=self.children).measureText(' ')
+        for i in range(start, end):
+            node, word, w, space, child_class = self.items[i]
+            if word and isinstance(self.previous_word, TextRunLayout) \
+                and self.previous_word.node is node:
+                self.previous_word.words.append(word)
+                continue
+            if word:
+                child = child_class(node, [word], line, self.previous_word)
+            else:
+                child = child_class(node, line, self.previous_word,
+                    self.frame)
+            line.children.append(child)
+            self.previous_word = child
 
     def self_rect(self):
         return skia.Rect.MakeLTRB(
@@ -500,6 +847,15 @@ class BlockLayout:
         cmds = paint_visual_effects(self.node, cmds, self.self_rect())
         return cmds
 
+    def paint_dependencies(self):
+        if isinstance(self.node, Element) and \
+            "contenteditable" in self.node.attributes:
+            return None
+        return [self.x, self.y, self.width, self.height, self.zoom,
+            self.children] + [self.node.style[property] for property in [
+                "background-color", "border-radius", "opacity",
+                "mix-blend-mode", "transform", "overflow"]]
+
 def DrawCursor(elt, offset):
     x = elt.x.get() + offset
     return DrawLine(x, elt.y.get(), x, elt.y.get() + elt.height.get(), "red", 1)
@@ -528,6 +884,7 @@ class LineLayout:
             [self.parent.width])
         self.height = ProtectedField(self, "height", self.parent,
             [self.ascent, self.descent])
+        self.paint_cache = None
 
         self.has_dirty_descendants = True
 
@@ -611,6 +968,10 @@ class LineLayout:
             paint_outline(outline_node, cmds, outline_rect, self.zoom.get())
         return cmds
 
+    def paint_dependencies(self):
+        nodes = set([child.node.parent for child in self.children])
+        return [self.zoom] + [node.style["outline"] for node in nodes]
+
 @wbetools.patch(TextLayout)
 class TextLayout:
     def __init__(self, node, word, parent, previous):
@@ -644,6 +1005,7 @@ class TextLayout:
             x_dependencies)
         self.y = ProtectedField(self, "y", self.parent,
             [self.ascent, self.parent.y, self.parent.ascent])
+        self.paint_cache = None
 
         self.has_dirty_descendants = True
 
@@ -668,13 +1030,13 @@ class TextLayout:
         self.font.set(font(self.node.style, zoom, notify=self.font))
 
         f = self.font.read(notify=self.width)
-        self.width.set(f.measureText(self.word))
+        self.width.set(measure_word(f, self.word))
 
         f = self.font.read(notify=self.ascent)
-        self.ascent.set(f.getMetrics().fAscent * 1.25)
+        self.ascent.set(font_metrics(f).ascent * 1.25)
 
         f = self.font.read(notify=self.descent)
-        self.descent.set(f.getMetrics().fDescent * 1.25)
+        self.descent.set(font_metrics(f).descent * 1.25)
 
         f = self.font.read(notify=self.height)
         self.height.set(linespace(f) * 1.25)
@@ -684,7 +1046,7 @@ class TextLayout:
             prev_font = self.previous.font.read(notify=self.x)
             prev_width = self.previous.width.read(notify=self.x)
             self.x.set(
-                prev_x + prev_font.measureText(' ') + prev_width)
+                prev_x + font_metrics(prev_font).space + prev_width)
         else:
             self.x.copy(self.parent.x)
 
@@ -704,6 +1066,64 @@ class TextLayout:
             self.x.get(), self.y.get(), self.x.get() + self.width.get(),
             self.y.get() + self.height.get())
 
+    def paint_dependencies(self):
+        return [self.x, self.y, self.width, self.height, self.font,
+            self.node.style["color"]]
+
+class TextRunLayout(TextLayout):
+    def __init__(self, node, words, parent, previous):
+        super().__init__(node, None, parent, previous)
+        self.words = words
+
+    def layout(self):
+        if not self.layout_needed(): return
+
+        self.zoom.copy(self.parent.zoom)
+
+        zoom = self.zoom.read(notify=self.font)
+        self.font.set(font(self.node.style, zoom, notify=self.font))
+
+        f = self.font.read(notify=self.width)
+        space = font_metrics(f).space
+        width = space * (len(self.words) - 1)
+        for word in self.words:
+            width += measure_word(f, word)
+        self.width.set(width)
+
+        f = self.font.read(notify=self.ascent)
+        self.ascent.set(font_metrics(f).ascent * 1.25)
+
+        f = self.font.read(notify=self.descent)
+        self.descent.set(font_metrics(f).descent * 1.25)
+
+        f = self.font.read(notify=self.height)
+        self.height.set(linespace(f) * 1.25)
+
+        if self.previous:
+            prev_x = self.previous.x.read(notify=self.x)
+            prev_font = self.previous.font.read(notify=self.x)
+            prev_width = self.previous.width.read(notify=self.x)
+            self.x.set(
+                prev_x + font_metrics(prev_font).space + prev_width)
+        else:
+            self.x.copy(self.parent.x)
+
+        self.has_dirty_descendants = False
+
+    def paint(self):
+        leading = self.height.get() / 1.25 * .25 / 2
+        color = self.node.style['color'].get()
+        return [DrawText(
+            self.x.get(), self.y.get() + leading,
+            " ".join(self.words), self.font.get(), color,
+            self.width.get())]
+
+    @wbetools.js_hide
+    def __repr__(self):
+        return ("TextRunLayout(x={}, y={}, width={}, height={}, " +
+            "words={})").format(self.x, self.y, self.width, self.height,
+            " ".join(self.words))
+
 
 @wbetools.patch(EmbedLayout)
 class EmbedLayout:
@@ -740,6 +1160,7 @@ class EmbedLayout:
             self, "x", self.parent, x_dependencies)
         self.y = ProtectedField(self, "y", self.parent,
             [self.ascent,self.parent.y, self.parent.ascent])
+        self.paint_cache = None
 
         self.has_dirty_descendants = True
 
@@ -766,12 +1187,15 @@ class EmbedLayout:
             prev_x = self.previous.x.read(notify=self.x)
             prev_font = self.previous.font.read(notify=self.x)
             prev_width = self.previous.width.read(notify=self.x)
-            self.x.set(prev_x + prev_font.measureText(' ') + prev_width)
+            self.x.set(prev_x + font_metrics(prev_font).space + prev_width)
         else:
             self.x.copy(self.parent.x)
 
         self.has_dirty_descendants = False
 
+    def paint_dependencies(self):
+        return None
+
 @wbetools.patch(InputLayout)
 class InputLayout(EmbedLayout):
     def layout(self):
@@ -889,7 +1313,7 @@ class IframeLayout(EmbedLayout):
         else:
             self.height.set(dpx(IFRAME_HEIGHT_PX + 2, zoom)) 
 
-        if self.node.frame and self.node.frame.loaded:
+        if self.node.frame and self.node.frame.renderable:
             self.node.frame.frame_height = \
                 self.height.get() - dpx(2, self.zoom.get())
             self.node.frame.frame_width = \
@@ -935,55 +1359,108 @@ class IframeLayout(EmbedLayout):
         cmds = paint_visual_effects(self.node, cmds, inner_rect)
         return cmds
 
+class ComputedStyle:
+    __slots__ = ["fields"]
+
+    PROPERTIES = list(CSS_PROPERTIES)
+    INDEX = dict([
+        (property, i) for i, property in enumerate(PROPERTIES)
+    ])
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    def __getitem__(self, property):
+        return self.fields[self.INDEX[property]]
+
+    def __contains__(self, property):
+        return property in self.INDEX
+
+    def __iter__(self):
+        return iter(self.PROPERTIES)
+
+    def __len__(self):
+        return len(self.fields)
+
+    def keys(self):
+        return self.PROPERTIES
+
+    def values(self):
+        return self.fields
+
+    def items(self):
+        return zip(self.PROPERTIES, self.fields)
+
+    @wbetools.js_hide
+    def __repr__(self):
+        return "ComputedStyle({})".format(", ".join([
+            "{}={}".format(property, field)
+            for property, field in self.items()
+        ]))
+
+def intern_value(value):
+    if isinstance(value, str):
+        return sys.intern(value)
+    return value
+
 def init_style(node):
-    node.style = dict([
-            (property, ProtectedField(node, property, None,
-                [node.parent.style[property]] \
-                    if node.parent and \
-                        property in INHERITED_PROPERTIES \
-                    else []))
-            for property in CSS_PROPERTIES
-        ])
+    node.style = ComputedStyle([
+        ProtectedField(node, property, node.parent,
+            [node.parent.style[property]] \
+                if node.parent and \
+                    property in INHERITED_PROPERTIES \
+                else [])
+        for property in CSS_PROPERTIES
+    ])
 
 @wbetools.patch(style)
 def style(node, rules, frame):
     if not node.style:
         init_style(node)
-    needs_style = any([field.dirty for field in node.style.values()])
+    needs_style = any(field.dirty for field in node.style.values())
     if needs_style:
         old_style = dict([
             (property, field.value)
             for property, field in node.style.items()
         ])
-        new_style = CSS_PROPERTIES.copy()
-        for property, default_value in INHERITED_PROPERTIES.items():
+        key, shared = rules.lookup_style(node)
+        if shared:
+            new_style = shared.copy()
             if node.parent:
-                parent_field = node.parent.style[property]
-                parent_value = \
-                    parent_field.read(notify=node.style[property])
-                new_style[property] = parent_value
-            else:
-                new_style[property] = default_value
-        for media, selector, body in rules:
-            if media:
-                if (media == 'dark') != frame.tab.dark_mode: continue
-            if not selector.matches(node): continue
-            for property, value in body.items():
-                new_style[property] = value
-        if isinstance(node, Element) and 'style' in node.attributes:
-            pairs = CSSParser(node.attributes['style']).body()
-            for property, value in pairs.items():
-                new_style[property] = value
-        if new_style["font-size"].endswith("%"):
-            if node.parent:
-                parent_field = node.parent.style["font-size"]
-                parent_font_size = \
-                    parent_field.read(notify=node.style["font-size"])
-            else:
-                parent_font_size = INHERITED_PROPERTIES["font-size"]
-            node_pct = float(new_style["font-size"][:-1]) / 100
-            parent_px = float(parent_font_size[:-2])
-            new_style["font-size"] = str(node_pct * parent_px) + "px"
+                for property in INHERITED_PROPERTIES:
+                    node.parent.style[property].read(
+                        notify=node.style[property])
+        else:
+            new_style = CSS_PROPERTIES.copy()
+            for property, default_value in INHERITED_PROPERTIES.items():
+                if node.parent:
+                    parent_field = node.parent.style[property]
+                    parent_value = \
+                        parent_field.read(notify=node.style[property])
+                    new_style[property] = parent_value
+                else:
+                    new_style[property] = default_value
+            for media, selector, body in rules.candidates(node):
+                if media:
+                    if (media == 'dark') != frame.tab.dark_mode: continue
+                if not selector.matches(node): continue
+                for property, value in body.items():
+                    new_style[property] = value
+            if isinstance(node, Element) and 'style' in node.attributes:
+                pairs = parse_inline_style(node.attributes['style'])
+                for property, value in pairs.items():
+                    new_style[property] = value
+            if new_style["font-size"].endswith("%"):
+                if node.parent:
+                    parent_field = node.parent.style["font-size"]
+                    parent_font_size = \
+                        parent_field.read(notify=node.style["font-size"])
+                else:
+                    parent_font_size = INHERITED_PROPERTIES["font-size"]
+                node_pct = float(new_style["font-size"][:-1]) / 100
+                parent_px = float(parent_font_size[:-2])
+                new_style["font-size"] = str(node_pct * parent_px) + "px"
+            rules.store_style(node, key, new_style.copy())
         if old_style:
             transitions = diff_styles(old_style, new_style)
             for property, (old_value, new_value, num_frames) in \
@@ -995,14 +1472,31 @@ def style(node, rules, frame):
                     node.animations[property] = animation
                     new_style[property] = animation.animate()
         for property, field in node.style.items():
-            field.set(new_style[property])
+            field.set(intern_value(new_style[property]))
 
-    for child in node.children:
-        style(child, rules, frame)
+    if not node.has_dirty_descendants: return
+    rules.push_ancestor(node)
+    try:
+        for child in node.children:
+            style(child, rules, frame)
+    finally:
+        rules.pop_ancestor()
+    node.has_dirty_descendants = False
 
 def dirty_style(node):
-    for property, value in node.style.items():
-        value.mark()
+    if node.style:
+        for property, value in node.style.items():
+            value.mark()
+    else:
+        # Unstyled nodes are new; make sure style() walks down to them
+        parent = node.parent
+        while parent and not parent.has_dirty_descendants:
+            parent.has_dirty_descendants = True
+            parent = parent.parent
+
+def dirty_new_nodes(parser):
+    for node in parser.take_new_nodes():
+        dirty_style(node)
 
 @wbetools.patch(JSContext)
 class JSContext:
@@ -1016,6 +1510,7 @@ class JSContext:
         elt.children = new_nodes
         for child in elt.children:
             child.parent = elt
+            dirty_style(child)
         obj = elt.layout_object
         if obj:
             while not isinstance(obj, BlockLayout):
@@ -1027,14 +1522,23 @@ class JSContext:
         frame = self.tab.window_id_to_frame[window_id]        
         self.throw_if_cross_origin(frame)
         elt = self.handle_to_node[handle]
+        old_classes = node_classes(elt)
         elt.attributes[attr] = value
+        if attr == "style":
+            dirty_style(elt)
+        elif attr == "class":
+            changed = old_classes ^ node_classes(elt)
+            frame.invalidate_style(elt,
+                [("class", class_name) for class_name in changed])
         obj = elt.layout_object
         if isinstance(obj, IframeLayout) or \
            isinstance(obj, ImageLayout):
             if attr == "width" or attr == "height":
                 obj.width.mark()
                 obj.height.mark()
-        self.tab.set_needs_render_all_frames()
+                # The iframe's own frame has to re-layout at the new size
+                self.tab.set_needs_render_all_frames()
+        frame.set_needs_render()
 
     def style_set(self, handle, s, window_id):
         frame = self.tab.window_id_to_frame[window_id]
@@ -1045,32 +1549,186 @@ class JSContext:
         frame.set_needs_render()
 
 def paint_tree(layout_object, display_list):
+    cache = layout_object.paint_cache
+    if cache and not cache.dirty:
+        display_list.extend(cache.get())
+        return True
+
     cmds = layout_object.paint()
+    cacheable = True
 
     if isinstance(layout_object, IframeLayout) and \
         layout_object.node.frame and \
-        layout_object.node.frame.loaded:
+        layout_object.node.frame.renderable:
         paint_tree(layout_object.node.frame.document, cmds)
     else:
         if isinstance(layout_object.children, ProtectedField):
             for child in layout_object.children.get():
-                paint_tree(child, cmds)
+                cacheable &= paint_tree(child, cmds)
         else:
             for child in layout_object.children:
-                paint_tree(child, cmds)
+                cacheable &= paint_tree(child, cmds)
 
     cmds = layout_object.paint_effects(cmds)
     display_list.extend(cmds)
 
+    if not cacheable: return False
+    if not cache:
+        dependencies = layout_object.paint_dependencies()
+        if dependencies == None: return False
+        cache = PaintCache(layout_object, "paint", layout_object.parent,
+            dependencies)
+        layout_object.paint_cache = cache
+    cache.set(cmds)
+    return True
+
+def deferred_blocks(layout_object, top, bottom, blocks):
+    children = layout_object.children
+    if isinstance(children, ProtectedField):
+        children = children.get()
+    for child in children:
+        if not isinstance(child, BlockLayout): break
+        y = child.y.get()
+        if y > bottom: break
+        if y + child.height.get() < top: continue
+        if child.deferred:
+            blocks.append(child)
+        else:
+            deferred_blocks(child, top, bottom, blocks)
+    return blocks
+
+def scroll_anchor(layout_object, scroll):
+    while isinstance(layout_object, DocumentLayout) or \
+        isinstance(layout_object, BlockLayout):
+        children = layout_object.children
+        if isinstance(children, ProtectedField):
+            children = children.get()
+        for child in children:
+            if child.y.get() + child.height.get() > scroll:
+                layout_object = child
+                break
+        else:
+            break
+    return layout_object
+
+class DisplayListStats:
+    def __init__(self):
+        self.commands_in = 0
+        self.commands_out = 0
+        self.time = 0
+
+    @wbetools.js_hide
+    def __repr__(self):
+        return "DisplayListStats(in={}, out={}, ms={:.2f})".format(
+            self.commands_in, self.commands_out, self.time * 1000)
+
+def is_empty_command(cmd):
+    if isinstance(cmd, DrawText):
+        return not cmd.text.strip()
+    if isinstance(cmd, DrawRRect) or isinstance(cmd, DrawRect) or \
+        isinstance(cmd, DrawImage):
+        return cmd.rect.isEmpty()
+    return False
+
+def is_mask(cmd):
+    return isinstance(cmd, Blend) and cmd.blend_mode == "destination-in"
+
+def merge_text(cmds, stats):
+    out = []
+    run = []
+    for cmd in cmds + [None]:
+        if run and isinstance(cmd, DrawText) and \
+            cmd.font is run[0].font and cmd.color == run[0].color and \
+            cmd.rect.top() == run[0].rect.top():
+            run.append(cmd)
+            continue
+        if len(run) > 1:
+            out.append(DrawTextBlob(run, run[0].font, run[0].color))
+            stats.commands_out -= len(run) - 1
+        else:
+            out.extend(run)
+        run = []
+        if isinstance(cmd, DrawText):
+            run.append(cmd)
+        elif cmd:
+            out.append(cmd)
+    return out
+
+def optimize_effect(effect):
+    stats = DisplayListStats()
+    stats.commands_in += 1
+    masked = isinstance(effect, Blend) and effect.children and \
+        is_mask(effect.children[-1])
+    if masked:
+        mask = effect.children[-1]
+        mask_size = len(tree_to_list(mask, []))
+        stats.commands_in += mask_size
+        if mask.rect.isEmpty():
+            stats.commands_in += len(tree_to_list(effect, [])) - 1 - \
+                mask_size
+            children = []
+        else:
+            children = optimize_display_list(effect.children[:-1], stats)
+            visible = [child for child in children
+                if not isinstance(child, PaintCommand) or
+                    skia.Rect.Intersects(child.rect, mask.rect)]
+            stats.commands_out -= len(children) - len(visible)
+            if visible:
+                children = visible + [mask]
+                stats.commands_out += mask_size
+            else:
+                children = []
+    else:
+        children = optimize_display_list(effect.children, stats)
+
+    if isinstance(effect, Transform) and not effect.translation or \
+        isinstance(effect, Blend) and not effect.should_save and \
+        not masked:
+        result = children
+    elif not children:
+        result = []
+    elif children == effect.children:
+        result = [effect]
+        stats.commands_out += 1
+    elif isinstance(effect, Blend):
+        result = [Blend(effect.opacity, effect.blend_mode, effect.node,
+            children)]
+        stats.commands_out += 1
+    elif isinstance(effect, Transform):
+        result = [Transform(effect.translation, effect.self_rect,
+            effect.node, children)]
+        stats.commands_out += 1
+    else:
+        result = [effect]
+        stats.commands_out += 1
+    effect.optimized = (result, stats.commands_in, stats.commands_out)
+
+def optimize_display_list(cmds, stats):
+    out = []
+    for cmd in cmds:
+        if isinstance(cmd, VisualEffect):
+            if not cmd.optimized:
+                optimize_effect(cmd)
+            result, commands_in, commands_out = cmd.optimized
+            out.extend(result)
+            stats.commands_in += commands_in
+            stats.commands_out += commands_out
+        else:
+            stats.commands_in += 1
+            if not is_empty_command(cmd):
+                out.append(cmd)
+                stats.commands_out += 1
+    return merge_text(out, stats)
+
 @wbetools.patch(Frame)
 class Frame:
-    def load(self, url, payload=None):
+    def load_stream(self, url, headers, chunks):
         self.loaded = False
+        self.renderable = False
         self.zoom = 1
         self.scroll = 0
         self.scroll_changed_in_frame = True
-        headers, body = url.request(self.url, payload)
-        body = body.decode("utf8", "replace")
+        self.scroll_anchor = None
         self.url = url
 
         self.allowed_origins = None
@@ -1079,89 +1737,64 @@ class Frame:
            if len(csp) > 0 and csp[0] == "default-src":
                self.allowed_origins = csp[1:]
 
-        self.nodes = HTMLParser(body).parse()
-
         if self.js: self.js.discarded = True
         self.js = self.tab.get_js(url)
         self.js.add_window(self)
 
-        scripts = [node.attributes["src"] for node
-                   in tree_to_list(self.nodes, [])
-                   if isinstance(node, Element)
-                   and node.tag == "script"
-                   and "src" in node.attributes]
-        for script in scripts:
-            script_url = url.resolve(script)
-            if not self.allowed_request(script_url):
-                print("Blocked script", script, "due to CSP")
-                continue
-
-            try:
-                header, body = script_url.request(url)
-            except:
-                continue
-            body = body.decode("utf8", "replace")
-            task = Task(self.js.run, script_url, body,
-                self.window_id)
-            self.tab.task_runner.schedule_task(task)
-
         self.rules = DEFAULT_STYLE_SHEET.copy()
-        links = [node.attributes["href"]
-                 for node in tree_to_list(self.nodes, [])
-                 if isinstance(node, Element)
-                 and node.tag == "link"
-                 and node.attributes.get("rel") == "stylesheet"
-                 and "href" in node.attributes]
-        for link in links:  
-            style_url = url.resolve(link)
-            if not self.allowed_request(style_url):
-                print("Blocked style", link, "due to CSP")
-                continue
-            try:
-                header, body = style_url.request(url)
-            except:
-                continue
-            self.rules.extend(CSSParser(body.decode("utf8", "replace")).parse())
-
-        images = [node
-            for node in tree_to_list(self.nodes, [])
-            if isinstance(node, Element)
-            and node.tag == "img"]
-        for img in images:
-            try:
-                src = img.attributes.get("src", "")
-                image_url = url.resolve(src)
-                assert self.allowed_request(image_url), \
-                    "Blocked load of " + str(image_url) + " due to CSP"
-                header, body = image_url.request(url)
-                img.encoded_data = body
-                data = skia.Data.MakeWithoutCopy(body)
-                img.image = skia.Image.MakeFromEncoded(data)
-                assert img.image, \
-                    "Failed to recognize image format for " + str(image_url)
-            except Exception as e:
-                print("Image", img.attributes.get("src", ""),
-                    "crashed", e)
-                img.image = BROKEN_IMAGE
-
-        iframes = [node
-                   for node in tree_to_list(self.nodes, [])
-                   if isinstance(node, Element)
-                   and node.tag == "iframe"
-                   and "src" in node.attributes]
-        for iframe in iframes:
-            document_url = url.resolve(iframe.attributes["src"])
-            if not self.allowed_request(document_url):
-                print("Blocked iframe", document_url, "due to CSP")
-                iframe.frame = None
-                continue
-            iframe.frame = Frame(self.tab, self, iframe)
-            task = Task(iframe.frame.load, document_url)
-            self.tab.task_runner.schedule_task(task)
+        self.rule_index = None
+        self.rules_changed = False
+        parser = HTMLParser()
+        decoder = codecs.getincrementaldecoder("utf8")("replace")
+        next_render = time.time() + PARTIAL_RENDER_INTERVAL_SEC
+        for chunk in chunks:
+            parser.feed(decoder.decode(chunk))
+            if time.time() >= next_render:
+                start = time.time()
+                self.render_partial(parser)
+                elapsed = time.time() - start
+                next_render = time.time() + \
+                    max(PARTIAL_RENDER_INTERVAL_SEC, 4 * elapsed)
+        parser.feed(decoder.decode(b"", True))
+        self.nodes = parser.finish()
+        dirty_new_nodes(parser)
+
+        self.load_subresources(url)
+
+        self.document = DocumentLayout(self.nodes, self)
+        self.renderable = True
+        self.set_needs_render()
+        self.check_loaded()
 
+    def render_partial(self, parser):
+        self.nodes = parser.partial_tree()
+        if not self.nodes or not self.frame_width: return
+        dirty_new_nodes(parser)
         self.document = DocumentLayout(self.nodes, self)
+        self.renderable = True
         self.set_needs_render()
-        self.loaded = True
+        if self != self.tab.root_frame: return
+        self.tab.run_animation_frame(self.tab.root_frame.scroll)
+
+    def image_loaded(self, img, response):
+        decode_image(img, response)
+        obj = img.layout_object
+        if obj:
+            while not isinstance(obj, BlockLayout):
+                obj = obj.parent
+            obj.children.mark()
+        self.set_needs_layout()
+
+    def get_rule_index(self):
+        if not self.rule_index:
+            self.rule_index = RuleIndex(
+                sorted(self.rules, key=cascade_priority))
+        return self.rule_index
+
+    def invalidate_style(self, node, keys):
+        for invalidated in self.get_rule_index().invalidated_nodes(
+            node, keys):
+            if invalidated.style: dirty_style(invalidated)
 
     def render(self):
         if self.needs_style:
@@ -1169,14 +1802,18 @@ class Frame:
                 INHERITED_PROPERTIES["color"] = "white"
             else:
                 INHERITED_PROPERTIES["color"] = "black"
-            style(self.nodes,
-                  sorted(self.rules,
-                         key=cascade_priority), self)
+            if self.rules_changed:
+                self.update_rules()
+                for node in tree_to_list(self.nodes, []):
+                    if node.style: dirty_style(node)
+            style(self.nodes, self.get_rule_index(), self)
             self.needs_layout = True
             self.needs_style = False
 
         if self.needs_layout:
             self.document.layout(self.frame_width, self.tab.zoom)
+            if wbetools.LAZY_LAYOUT:
+                self.layout_near_viewport()
             self.tab.needs_accessibility = True
             self.needs_paint = True
             self.needs_layout = False
@@ -1186,6 +1823,30 @@ class Frame:
             self.scroll_changed_in_frame = True
         self.scroll = clamped_scroll
 
+    def reveal_deferred(self):
+        top = self.scroll - LAZY_LAYOUT_MARGIN
+        bottom = self.scroll + self.frame_height + LAZY_LAYOUT_MARGIN
+        blocks = deferred_blocks(self.document, top, bottom, [])
+        if not blocks: return False
+        if not self.scroll_anchor:
+            anchor = scroll_anchor(self.document, self.scroll)
+            self.scroll_anchor = (anchor, anchor.y.get())
+        for block in blocks:
+            block.children.mark()
+        self.needs_layout = True
+        return True
+
+    def layout_near_viewport(self):
+        while True:
+            if self.scroll_anchor:
+                anchor, anchor_y = self.scroll_anchor
+                self.scroll_anchor = None
+                if not anchor.y.dirty and anchor.y.get() != anchor_y:
+                    self.scroll += anchor.y.get() - anchor_y
+                    self.scroll_changed_in_frame = True
+            if not self.reveal_deferred(): break
+            self.document.layout(self.frame_width, self.tab.zoom)
+
     def keypress(self, char):
         if self.tab.focus and self.tab.focus.tag == "input":
             if not "value" in self.tab.focus.attributes:
@@ -1205,11 +1866,13 @@ class Frame:
             else:
                 last_text = Text("", self.tab.focus)
                 self.tab.focus.children.append(last_text)
+                dirty_style(last_text)
             last_text.text += char
             obj = self.tab.focus.layout_object
-            while not isinstance(obj, BlockLayout):
-                obj = obj.parent
-            obj.children.mark()
+            if obj:
+                while not isinstance(obj, BlockLayout):
+                    obj = obj.parent
+                obj.children.mark()
             self.set_needs_render()
 
     def scroll_to(self, elt):
@@ -1218,6 +1881,22 @@ class Frame:
             obj for obj in tree_to_list(self.document, [])
             if obj.node == self.tab.focus
         ]
+        while not objs and wbetools.LAZY_LAYOUT:
+            node = self.tab.focus
+            while node and not node.layout_object:
+                node = node.parent
+            if not node or not isinstance(node.layout_object, BlockLayout) \
+                or not node.layout_object.deferred:
+                break
+            self.scroll = self.clamp_scroll(
+                node.layout_object.y.get() - SCROLL_STEP)
+            self.scroll_changed_in_frame = True
+            self.layout_near_viewport()
+            self.set_needs_layout()
+            objs = [
+                obj for obj in tree_to_list(self.document, [])
+                if obj.node == self.tab.focus
+            ]
         if not objs: return
         obj = objs[0]
 
@@ -1238,14 +1917,15 @@ class Frame:
             self.needs_focus_scroll = True
         if self.tab.focus:
             self.tab.focus.is_focused = False
-            dirty_style(self.tab.focus)
+            self.tab.focused_frame.invalidate_style(
+                self.tab.focus, [("pseudoclass", "focus")])
         if self.tab.focused_frame and self.tab.focused_frame != self:
             self.tab.focused_frame.set_needs_render()
         self.tab.focus = node
         self.tab.focused_frame = self
         if node:
             node.is_focused = True
-            dirty_style(node)
+            self.invalidate_style(node, [("pseudoclass", "focus")])
         self.set_needs_render()
 
     def click(self, x, y):
@@ -1306,12 +1986,17 @@ class Tab:
 
         needs_composite = False
         for (window_id, frame) in self.window_id_to_frame.items():
-            if not frame.loaded:
+            if not frame.renderable:
                 continue
 
-            self.browser.measure.time('script-runRAFHandlers')
-            frame.js.dispatch_RAF(frame.window_id)
-            self.browser.measure.stop('script-runRAFHandlers')
+            if frame.loaded:
+                self.browser.measure.time('script-runRAFHandlers')
+                frame.js.dispatch_RAF(frame.window_id)
+                self.browser.measure.stop('script-runRAFHandlers')
+
+            if wbetools.LAZY_LAYOUT and \
+                not (frame.needs_style or frame.needs_layout):
+                frame.reveal_deferred()
     
             for node in tree_to_list(frame.nodes, []):
                 for (property_name, animation) in \
@@ -1370,7 +2055,7 @@ class Tab:
         self.browser.measure.time('render')
 
         for id, frame in self.window_id_to_frame.items():
-            if frame.loaded:
+            if frame.renderable:
                 frame.render()
 
         if self.needs_accessibility:
@@ -1384,6 +2069,14 @@ class Tab:
             self.browser.measure.time('paint')
             paint_tree(self.root_frame.document, self.display_list)
             self.browser.measure.stop('paint')
+            self.browser.measure.time('optimize')
+            start = time.time()
+            stats = DisplayListStats()
+            self.display_list = \
+                optimize_display_list(self.display_list, stats)
+            stats.time = time.time() - start
+            self.display_list_stats = stats
+            self.browser.measure.stop('optimize')
             self.needs_paint = False
 
         self.browser.measure.stop('render')
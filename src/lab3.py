@@ -5,11 +5,14 @@ Including exercises implemented by Tal Langus.
 """
 
 import wbetools
+import collections
+import json
 import socket
 import ssl
+import threading
 import tkinter
 import tkinter.font
-from lab1 import URL
+from lab1 import URL, Cache
 from lab2 import WIDTH, HEIGHT, HSTEP, VSTEP, SCROLL_STEP, Browser
 
 FONT_SIZE = 12
@@ -50,6 +53,7 @@ def lex(body):
     return out
 
 FONTS = {}
+FONT_KEYS = {}
 
 def get_font(size, weight, style, family=None):
     key = (size, weight, style, family)
@@ -59,8 +63,116 @@ def get_font(size, weight, style, family=None):
         else:
             font = tkinter.font.Font(size=size, weight=weight, slant=style)
         FONTS[key] = font
+        FONT_KEYS[id(font)] = key
     return FONTS[key]
 
+WORD_WIDTH_CACHE_SIZE = 50000
+
+class WordWidthCache:
+    FORMAT = "widths-v1"
+
+    def __init__(self, name, size=WORD_WIDTH_CACHE_SIZE,
+                 cache_dir="cached_data"):
+        self.lock = threading.Lock()
+        self.key = "word-widths:{}:{}".format(self.FORMAT, name)
+        self.size = size
+        self.widths = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.cache_dir = cache_dir
+        self.disk = None
+        self.loaded = False
+
+    def measure(self, font_key, word, measure):
+        key = (font_key, word)
+        self.lock.acquire(blocking=True)
+        if not self.loaded: self.load()
+        width = self.widths.get(key)
+        if width is not None:
+            self.widths.move_to_end(key)
+            self.hits += 1
+        self.lock.release()
+        if width is not None:
+            return width
+
+        width = measure(word)
+        self.lock.acquire(blocking=True)
+        self.misses += 1
+        self.widths[key] = width
+        if len(self.widths) > self.size:
+            self.widths.popitem(last=False)
+        self.lock.release()
+        return width
+
+    def lookup(self, font_key, words):
+        widths = []
+        self.lock.acquire(blocking=True)
+        if not self.loaded: self.load()
+        for word in words:
+            key = (font_key, word)
+            width = self.widths.get(key)
+            if width is not None:
+                self.widths.move_to_end(key)
+                self.hits += 1
+            widths.append(width)
+        self.lock.release()
+        return widths
+
+    def update(self, font_key, words, widths, misses):
+        self.lock.acquire(blocking=True)
+        self.misses += misses
+        for word, width in zip(words, widths):
+            self.widths[(font_key, word)] = width
+        while len(self.widths) > self.size:
+            self.widths.popitem(last=False)
+        self.lock.release()
+
+    def open_disk(self):
+        if not wbetools.PERSIST_WORD_WIDTHS or not self.cache_dir:
+            return None
+        if not self.disk:
+            self.disk = Cache(self.cache_dir)
+        return self.disk
+
+    def load(self):
+        self.loaded = True
+        try:
+            if not self.open_disk(): return
+            data = self.disk.get(self.key)
+            if data is None: return
+            for font_key, word, width in json.loads(data):
+                self.widths[(tuple(font_key), word)] = width
+        except (OSError, ValueError, TypeError):
+            self.widths.clear()
+        while len(self.widths) > self.size:
+            self.widths.popitem(last=False)
+
+    def save(self):
+        if not self.loaded or not wbetools.PERSIST_WORD_WIDTHS: return
+        self.lock.acquire(blocking=True)
+        data = [[font_key, word, width]
+            for (font_key, word), width in self.widths.items()]
+        self.lock.release()
+        try:
+            if not self.open_disk(): return
+            self.disk.set(self.key,
+                json.dumps(data, separators=(",", ":")).encode("utf8"))
+        except OSError:
+            pass
+
+    @wbetools.js_hide
+    def __repr__(self):
+        return "WordWidthCache(entries={}, hits={}, misses={})".format(
+            len(self.widths), self.hits, self.misses)
+
+WORD_WIDTHS = WordWidthCache("tk")
+
+def measure_word(font, word):
+    font_key = FONT_KEYS.get(id(font))
+    if font_key is None:
+        return font.measure(word)
+    return WORD_WIDTHS.measure(font_key, word, font.measure)
+
 def find_soft_hyphen_break(word, font, start_x, max_width):
     SOFT_HYPHEN = "\u00AD"
     parts = []
@@ -178,7 +290,7 @@ class Layout:
         SOFT_HYPHEN = "\u00AD"
         word = word.upper() if self.in_abbr else word
         font = get_font(self.size, self.weight, self.style)
-        w = font.measure(word)
+        w = measure_word(font, word)
         if self.cursor_x + w > WIDTH - HSTEP and SOFT_HYPHEN in word:
             prefix, suffix = find_soft_hyphen_break(word, font, self.cursor_x, WIDTH - HSTEP)
             if prefix:
@@ -191,7 +303,8 @@ class Layout:
             self.flush()
         display_word = word.replace(SOFT_HYPHEN, "")
         self.line.append((self.cursor_x, display_word, font, self.in_sup_tag))
-        self.cursor_x += font.measure(display_word) + font.measure(" ")
+        self.cursor_x += measure_word(font, display_word) + \
+            measure_word(font, " ")
 
     def pre_text(self, text):
         font = get_font(self.size, self.weight, self.style, family="Courier New")
@@ -200,7 +313,7 @@ class Layout:
             x = self.cursor_x
             for c in line:
                 self.line.append((x, c, font, self.in_sup_tag))
-                x += font.measure(c)
+                x += measure_word(font, c)
             if i < len(lines) - 1:
                 self.flush()
         self.cursor_x = x
@@ -218,7 +331,7 @@ class Layout:
             line_width = 0
             if self.line:
                 last_x, last_word, last_font, *_ = self.line[-1]
-                line_width = last_x + last_font.measure(last_word) - HSTEP
+                line_width = last_x + measure_word(last_font, last_word) - HSTEP
             offset = (WIDTH - line_width) // 2 if line_width < WIDTH else 0
         else:
             offset = 0
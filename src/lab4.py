@@ -12,7 +12,7 @@ import tkinter.font
 import re
 from lab1 import URL, html_unescape
 from lab2 import WIDTH, HEIGHT, HSTEP, VSTEP, SCROLL_STEP
-from lab3 import FONTS, get_font, Layout, Browser
+from lab3 import FONTS, get_font, measure_word, Layout, Browser
 
 class Text:
     def __init__(self, text, parent):
@@ -44,82 +44,138 @@ def print_tree(node, indent=0):
         print_tree(child, indent + 2)
 
 class HTMLParser:
-    def __init__(self, body):
+    def __init__(self, body=""):
         self.body = body
         self.unfinished = []
         self.unfinished_format_tags = []
         self.misnested_format_tags = []
-        self.body_index = 0  
+        self.open_nodes = set()
+        self.open_counts = {}
+        self.format_counts = {}
+        self.body_index = 0
+        self.scanned = 0
+        self.text = ""
+        self.in_tag = False
+        self.in_script = False
+        self.eof = False
+        self.provisional = []
+        self.chunks = []
+        self.waiting_for = None
+        self.tail = ""
+        self.new_nodes = []
 
     def parse(self):
-        text = ""
-        in_tag = False
-        in_script = False
-        self.body_index = 0
+        return self.finish()
 
-        while self.body_index < len(self.body):
-            if not in_script and self.body.startswith("<!--", self.body_index):
-                self.skip_comment()
-                in_tag = False
-                text = ""
+    def feed(self, data):
+        self.detach_provisional()
+        self.chunks.append(data)
+        if self.waiting_for:
+            # Only join the buffer once the pending token can complete
+            tail = self.tail + data
+            if self.waiting_for not in tail:
+                keep = len(self.waiting_for) - 1
+                self.tail = tail[max(0, len(tail) - keep):] if keep else ""
+                return
+        self.waiting_for = None
+        self.scanned -= self.body_index
+        self.body = self.body[self.body_index:] + "".join(self.chunks)
+        self.chunks = []
+        self.body_index = 0
+        self.tokenize()
+
+    def wait_for(self, terminator):
+        self.waiting_for = terminator
+        start = len(self.body) - len(terminator) + 1
+        self.tail = self.body[max(self.body_index, start):]
+
+    def take_new_nodes(self):
+        nodes = self.new_nodes
+        self.new_nodes = []
+        return nodes
+
+    def tokenize(self):
+        body = self.body
+        while self.body_index < len(body):
+            if self.in_script:
+                if not self.eof and \
+                    self.find_terminator("</script>") == -1:
+                    self.wait_for("</script>")
+                    break
+                self.in_script = not self.handle_script_content()
+                self.text = ""
                 continue
-            if not in_script and self.body.startswith("<script", self.body_index):
-                in_tag = True
-                if text: self.add_text(text)
-                text = ""
-                self.handle_script_tag()
-                in_script = True
+            if body[self.body_index] != "<":
+                text_end = body.find("<", self.body_index)
+                if text_end == -1: text_end = len(body)
+                self.text += body[self.body_index:text_end]
+                self.body_index = text_end
                 continue
-            if in_script:
-                in_script = not self.handle_script_content()
-                text = ""
+            if not self.eof and self.is_partial_token():
+                break
+            if body.startswith("<!--", self.body_index):
+                if not self.eof and \
+                    self.find_terminator("-->") == -1:
+                    self.wait_for("-->")
+                    break
+                self.skip_comment()
+                self.in_tag = False
+                self.text = ""
                 continue
-            c = self.body[self.body_index]
-            if c == "<":
-                in_tag = True
-                if text: self.add_text(text)
-                text = ""
-                tag_content = self.read_tag()
-                self.add_tag(tag_content)
-                in_tag = False
-                text = ""
+            if body.startswith("<script", self.body_index):
+                if not self.eof and \
+                    body.find(">", self.body_index) == -1:
+                    self.wait_for(">")
+                    break
+                self.in_tag = True
+                if self.text: self.add_text(self.text)
+                self.text = ""
+                self.handle_script_tag()
+                self.in_script = True
                 continue
-            else:
-                text += c
-                self.body_index += 1
-        if not in_tag and text:
-            self.add_text(text)
-        return self.finish()
+            start = self.body_index
+            tag_content = self.read_tag()
+            if tag_content == None:
+                self.body_index = start
+                self.wait_for(">")
+                break
+            self.in_tag = True
+            if self.text: self.add_text(self.text)
+            self.text = ""
+            self.add_tag(tag_content)
+            self.in_tag = False
+
+    def is_partial_token(self):
+        rest = self.body[self.body_index:self.body_index + 7]
+        if len(rest) == 7: return False
+        return "<!--".startswith(rest) or "<script".startswith(rest)
+
+    TAG_END_OR_QUOTE = re.compile(r"[>\"']")
 
     def read_tag(self):
         assert self.body[self.body_index] == "<"
-        self.body_index += 1
-        tag = ""
-        in_quote = False
-        quote_char = ""
-        while self.body_index < len(self.body):
-            c = self.body[self.body_index]
-            if in_quote:
-                tag += c
-                if c == quote_char:
-                    in_quote = False
-                self.body_index += 1
-            else:
-                if c in ['"', "'"]:
-                    in_quote = True
-                    quote_char = c
-                    tag += c
-                    self.body_index += 1
-                elif c == ">":
-                    self.body_index += 1
-                    break
-                else:
-                    tag += c
-                    self.body_index += 1
-        return tag.strip()
+        start = self.body_index + 1
+        i = start
+        while True:
+            m = self.TAG_END_OR_QUOTE.search(self.body, i)
+            if m and m.group() == ">":
+                self.body_index = m.end()
+                return self.body[start:m.start()].strip()
+            if m:
+                i = self.body.find(m.group(), m.end()) + 1
+            if not m or i == 0:
+                if not self.eof: return None
+                self.body_index = len(self.body)
+                return self.body[start:].strip()
+
+    def find_terminator(self, terminator):
+        start = max(self.body_index, self.scanned - len(terminator))
+        end = self.body.find(terminator, start)
+        if end == -1: self.scanned = len(self.body)
+        return end
 
     def skip_comment(self):
-        end_comment = self.body.find("-->", self.body_index)
+        end_comment = self.find_terminator("-->")
         if end_comment == -1:
             self.body_index = len(self.body)
         else:
@@ -134,7 +190,7 @@ class HTMLParser:
         self.body_index = script_tag_end + 1
 
     def handle_script_content(self):
-        script_end = self.body.find("</script>", self.body_index)
+        script_end = self.find_terminator("</script>")
         if script_end == -1:
             script_content = self.body[self.body_index:]
             self.body_index = len(self.body)
@@ -164,8 +220,9 @@ class HTMLParser:
         if text.isspace(): return
         self.implicit_tags(None)
         parent = self.unfinished[-1]
-        node = Text(text, parent)
+        node = Text(self.unescape(text), parent)
         parent.children.append(node)
+        self.new_nodes.append(node)
 
     SELF_CLOSING_TAGS = [
         "area", "base", "br", "col", "embed", "hr", "img", "input",
@@ -185,21 +242,50 @@ class HTMLParser:
 
         if tag.startswith("/"):
             if len(self.unfinished) == 1: return
-            node = self.unfinished.pop()
+            node = self.pop_unfinished()
             parent = self.unfinished[-1]
             parent.children.append(node)
             if self.is_top_formatting_node(node):
-                self.unfinished_format_tags.pop()
+                self.pop_format_tag()
         elif tag in self.SELF_CLOSING_TAGS:
             parent = self.unfinished[-1]
             node = Element(tag, attributes, parent)
             parent.children.append(node)
+            self.new_nodes.append(node)
         else:
             parent = self.unfinished[-1] if self.unfinished else None
             node = Element(tag, attributes, parent)
-            self.unfinished.append(node)
+            self.new_nodes.append(node)
+            self.push_unfinished(node)
             if tag in self.FORMATTING_TAGS:
                 self.unfinished_format_tags.append(node)
+                self.format_counts[tag] = \
+                    self.format_counts.get(tag, 0) + 1
+
+    def push_unfinished(self, node):
+        self.unfinished.append(node)
+        self.open_nodes.add(node)
+        self.open_counts[node.tag] = self.open_counts.get(node.tag, 0) + 1
+
+    def pop_unfinished(self):
+        node = self.unfinished.pop()
+        self.open_nodes.remove(node)
+        self.open_counts[node.tag] -= 1
+        return node
+
+    def remove_unfinished(self, node):
+        # Misnested nodes are usually close to the top of the stack
+        i = len(self.unfinished) - 1
+        while self.unfinished[i] is not node:
+            i -= 1
+        del self.unfinished[i]
+        self.open_nodes.remove(node)
+        self.open_counts[node.tag] -= 1
+
+    def pop_format_tag(self):
+        node = self.unfinished_format_tags.pop()
+        self.format_counts[node.tag] -= 1
+        return node
 
     def is_top_formatting_node(self, node):
         return (
@@ -209,22 +295,23 @@ class HTMLParser:
         )
 
     def handle_misnested_formatting(self, tag):
+        if not self.format_counts.get(tag): return
         for i in range(len(self.unfinished_format_tags) - 1, -1, -1):
             node = self.unfinished_format_tags[i]
             if node.tag == tag:
                 # Close all formatting tags above this one
                 to_reopen = []
                 while len(self.unfinished_format_tags) - 1 > i:
-                    misnested_node = self.unfinished_format_tags.pop()
-                    if misnested_node in self.unfinished:
-                        self.unfinished.remove(misnested_node)
+                    misnested_node = self.pop_format_tag()
+                    if misnested_node in self.open_nodes:
+                        self.remove_unfinished(misnested_node)
                         parent = misnested_node.parent
                         if parent:
                             parent.children.append(misnested_node)
                     to_reopen.append(misnested_node.tag)
-                matching_node = self.unfinished_format_tags.pop()
-                if matching_node in self.unfinished:
-                    self.unfinished.remove(matching_node)
+                matching_node = self.pop_format_tag()
+                if matching_node in self.open_nodes:
+                    self.remove_unfinished(matching_node)
                     parent = matching_node.parent
                     if parent:
                         parent.children.append(matching_node)
@@ -237,45 +324,73 @@ class HTMLParser:
         "link", "meta", "title", "style", "script",
     ]
 
+    def insertion_mode(self):
+        depth = len(self.unfinished)
+        if depth == 0:
+            return "initial"
+        elif depth == 1 and self.unfinished[0].tag == "html":
+            return "before head"
+        elif depth == 2 and self.unfinished[0].tag == "html" and \
+            self.unfinished[1].tag == "head":
+            return "in head"
+        else:
+            return "in body"
+
     def implicit_tags(self, tag):
         while True:
-            open_tags = [node.tag for node in self.unfinished]
-            if open_tags == [] and tag != "html":
+            mode = self.insertion_mode()
+            if mode == "initial" and tag != "html":
                 self.add_tag("html")
-            elif open_tags == ["html"] \
+            elif mode == "before head" \
                  and tag not in ["head", "body", "/html"]:
                 if tag in self.HEAD_TAGS:
                     self.add_tag("head")
                 else:
                     self.add_tag("body")
-            elif open_tags == ["html", "head"] and \
-                 tag not in ["/head"] + self.HEAD_TAGS:
+            elif mode == "in head" and \
+                 tag != "/head" and tag not in self.HEAD_TAGS:
                 self.add_tag("/head")
-            elif tag == 'p' and 'p' in open_tags:
+            elif tag == 'p' and self.open_counts.get('p'):
                 self.add_tag('/p')
-            elif  tag == 'li' and 'li' in open_tags:
+            elif  tag == 'li' and self.open_counts.get('li'):
                 self.add_tag('/li')
             else:
                 break
 
     def finish(self):
+        self.detach_provisional()
+        self.waiting_for = None
+        if self.chunks: self.feed("")
+        self.eof = True
+        self.tokenize()
+        if not self.in_tag and self.text:
+            self.add_text(self.text)
+        self.text = ""
         if not self.unfinished:
             self.implicit_tags(None)
         while len(self.unfinished) > 1:
-            node = self.unfinished.pop()
+            node = self.pop_unfinished()
             parent = self.unfinished[-1]
             parent.children.append(node)
-        root = self.unfinished.pop()
-        self.unescape_tree(root)
+        root = self.pop_unfinished()
         return root
-    
-    def unescape_tree(self, node):
-        if isinstance(node, Text):
-            def replace_entity(match):
-                return html_unescape(match.group(0))
-            node.text = re.sub(r"&[a-zA-Z0-9#]+?;", replace_entity, node.text)
-        for child in getattr(node, "children", []):
-            self.unescape_tree(child)
+
+    def partial_tree(self):
+        self.detach_provisional()
+        for node in self.unfinished[1:]:
+            node.parent.children.append(node)
+            self.provisional.append(node)
+        return self.unfinished[0] if self.unfinished else None
+
+    def detach_provisional(self):
+        while self.provisional:
+            node = self.provisional.pop()
+            node.parent.children.pop()
+
+    def unescape(self, text):
+        def replace_entity(match):
+            return html_unescape(match.group(0))
+        return re.sub(r"&[a-zA-Z0-9#]+?;", replace_entity, text)
 
 @wbetools.patch(Layout)
 class Layout:
@@ -302,11 +417,11 @@ class Layout:
             self.flush()
             return
         font = get_font(self.size, self.weight, self.style)
-        w = font.measure(word)
+        w = measure_word(font, word)
         if self.cursor_x + w > WIDTH - HSTEP:
             self.flush()
         self.line.append((self.cursor_x, word, font))
-        self.cursor_x += w + font.measure(" ")
+        self.cursor_x += w + measure_word(font, " ")
 
     @wbetools.delete
     def flush(self):
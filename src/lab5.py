@@ -11,7 +11,7 @@ import tkinter
 import tkinter.font
 from lab1 import URL
 from lab2 import WIDTH, HEIGHT, HSTEP, VSTEP, SCROLL_STEP
-from lab3 import FONTS, get_font
+from lab3 import FONTS, get_font, measure_word
 from lab4 import Text, Element, print_tree, HTMLParser, Layout, Browser
 
 LIST_ELEMENTS= ["ul", "ol", "menu"]
@@ -108,11 +108,11 @@ class BlockLayout:
 
     def word(self, word):
         font = get_font(self.size, self.weight, self.style)
-        w = font.measure(word)
+        w = measure_word(font, word)
         if self.cursor_x + w > self.width:
             self.flush()
         self.line.append((self.cursor_x, word, font))
-        self.cursor_x += w + font.measure(" ")
+        self.cursor_x += w + measure_word(font, " ")
 
     def flush(self):
         if not self.line: return
@@ -4,6 +4,8 @@ up to and including Chapter 6 (Applying User Styles),
 without exercises.
 """
 
+import functools
+import re
 import wbetools
 import socket
 import ssl
@@ -11,7 +13,7 @@ import tkinter
 import tkinter.font
 from lab1 import URL
 from lab2 import WIDTH, HEIGHT, HSTEP, VSTEP, SCROLL_STEP
-from lab3 import FONTS, get_font
+from lab3 import FONTS, get_font, measure_word
 from lab4 import Text, Element, print_tree, HTMLParser
 from lab5 import DrawRect, DrawText, paint_tree
 from lab5 import BlockLayout, DocumentLayout, Browser
@@ -41,79 +43,106 @@ def tree_to_list(tree, list):
         tree_to_list(child, list)
     return list
 
+def cache_classes(node):
+    class_attr = node.attributes.get("class", "")
+    node.class_cache = (class_attr, frozenset(class_attr.split()))
+    return node.class_cache
+
+def node_classes(node):
+    cached = getattr(node, "class_cache", None)
+    if not cached or cached[0] != node.attributes.get("class", ""):
+        cached = cache_classes(node)
+    return cached[1]
+
+CSS_WHITESPACE = re.compile(r"\s*")
+CSS_WORD = re.compile(r":?[\w#.%-]*")
+# A whole "prop: value;" at once, with each word matched atomically;
+# \w also matches "_", which ends a word, so those take the slow path
+CSS_DECLARATION = re.compile(
+    r"(?=(:[\w#.%-]*|[\w#.%-]+))\1\s*:\s*" +
+    r"(?=(:[\w#.%-]*|[\w#.%-]+))\2\s*(?:;\s*|(?=})|\Z)")
+
 class CSSParser:
     def __init__(self, s):
         self.s = s
         self.i = 0
 
     def whitespace(self):
-        while self.i < len(self.s) and self.s[self.i].isspace():
-            self.i += 1
+        self.i = CSS_WHITESPACE.match(self.s, self.i).end()
 
     def literal(self, literal):
-        if not (self.i < len(self.s) and self.s[self.i] == literal):
-            raise Exception("Parsing error")
+        if not self.s.startswith(literal, self.i):
+            return False
         self.i += 1
+        return True
 
     def word(self):
         start = self.i
-        if self.i < len(self.s) and self.s[self.i] == ':':
-            self.i += 1
-        
-        while self.i < len(self.s):
-            if self.s[self.i].isalnum() or self.s[self.i] in "#-.%":
-                self.i += 1
-            else:
-                break
+        self.i = CSS_WORD.match(self.s, start).end()
+        underscore = self.s.find("_", start, self.i)
+        if underscore >= 0:
+            self.i = underscore
         if not (self.i > start):
-            raise Exception("Parsing error")
+            return None
         return self.s[start:self.i]
 
     def pair(self):
         prop = self.word()
+        if prop is None: return None
         self.whitespace()
-        self.literal(":")
+        if not self.literal(":"): return None
         self.whitespace()
         val = self.word()
+        if val is None: return None
         return prop.casefold(), val
 
     def ignore_until(self, chars):
-        while self.i < len(self.s):
-            if self.s[self.i] in chars:
-                return self.s[self.i]
-            else:
-                self.i += 1
+        pattern = re.compile("[^" + re.escape("".join(chars)) + "]*")
+        self.i = pattern.match(self.s, self.i).end()
+        if self.i < len(self.s):
+            return self.s[self.i]
         return None
 
     def body(self):
         pairs = {}
         while self.i < len(self.s) and self.s[self.i] != "}":
-            try:
-                prop, val = self.pair()
+            m = CSS_DECLARATION.match(self.s, self.i)
+            if m and "_" not in m.group(0):
+                pairs[m.group(1).casefold()] = m.group(2)
+                self.i = m.end()
+                continue
+            pair = self.pair()
+            if pair:
+                prop, val = pair
                 pairs[prop] = val
                 self.whitespace()
+                if self.literal(";"):
+                    self.whitespace()
+                    continue
+            why = self.ignore_until([";", "}"])
+            if why == ";":
                 self.literal(";")
                 self.whitespace()
-            except Exception:
-                why = self.ignore_until([";", "}"])
-                if why == ";":
-                    self.literal(";")
-                    self.whitespace()
-                else:
-                    break
+            else:
+                break
         return pairs
 
     def selector(self):
         word = self.word()
+        if word is None: return None
         out = get_discrete_selector(word.casefold())
         self.whitespace()
         while self.i < len(self.s) and self.s[self.i] != "{":
             word = self.word()
+            if word is None: return None
             
             if word == ':has':
                 out = self.get_has_selector(out)
-                while self.s[self.i] != "{":
-                    self.i +=1
+                if out is None: return None
+                self.i = self.s.find("{", self.i)
+                if self.i < 0:
+                    self.i = len(self.s)
+                    return None
                 break
             descendant = get_discrete_selector(word.casefold())
             out = DescendantSelector(out, descendant)
@@ -121,40 +150,55 @@ class CSSParser:
         return out
 
     def get_has_selector(self, ancestor_selector):
-        left_parenthesis = self.s[self.i:].index('(')
-        right_parenthesis = self.s[self.i:].index(')')
-        descendant_selector = CSSParser(self.s[self.i + left_parenthesis + 1:self.i + right_parenthesis]).selector()
+        left_parenthesis = self.s.find('(', self.i)
+        right_parenthesis = self.s.find(')', self.i)
+        if left_parenthesis < 0 or right_parenthesis < 0: return None
+        descendant_selector = CSSParser(self.s[left_parenthesis + 1:right_parenthesis]).selector()
+        if descendant_selector is None: return None
         return HasSelector(ancestor_selector, descendant_selector)
 
-        
-
     def parse(self):
         rules = []
         while self.i < len(self.s):
-            try:
-                self.whitespace()
-                selector = self.selector()
-                self.literal("{")
+            self.whitespace()
+            selector = self.selector()
+            if selector and self.literal("{"):
                 self.whitespace()
                 body = self.body()
+                if self.literal("}"):
+                    rules.append((selector, body))
+                    continue
+            why = self.ignore_until(["}"])
+            if why == "}":
                 self.literal("}")
-                rules.append((selector, body))
-            except Exception:
-                why = self.ignore_until(["}"])
-                if why == "}":
-                    self.literal("}")
-                    self.whitespace()
-                else:
-                    break
+                self.whitespace()
+            else:
+                break
         return rules
+
+INLINE_STYLE_CACHE_SIZE = 1024
+
+@functools.lru_cache(maxsize=INLINE_STYLE_CACHE_SIZE)
+def parse_inline_style(s):
+    return CSSParser(s).body()
     
 class TagSelector:
     def __init__(self, tag):
         self.tag = tag
         self.priority = 1
+        self.matches = self.compile()
+
+    def compile(self):
+        tag = self.tag
+        def matches(node):
+            return isinstance(node, Element) and tag == node.tag
+        return matches
 
-    def matches(self, node):
-        return isinstance(node, Element) and self.tag == node.tag
+    def index_key(self):
+        return ("tag", self.tag)
+
+    def filter_keys(self):
+        return [("tag", self.tag)]
 
     @wbetools.js_hide
     def __repr__(self):
@@ -165,11 +209,20 @@ class ClassSelector:
     def __init__(self, class_name):
         self.class_name = class_name
         self.priority = 10  
+        self.matches = self.compile()
+
+    def compile(self):
+        class_name = self.class_name
+        def matches(node):
+            if not isinstance(node, Element): return False
+            return class_name in node_classes(node)
+        return matches
+
+    def index_key(self):
+        return ("class", self.class_name)
 
-    def matches(self, node):
-        if not isinstance(node, Element): return False
-        classes = node.attributes.get("class", "").split()
-        return self.class_name in classes
+    def filter_keys(self):
+        return [("class", self.class_name)]
 
     @wbetools.js_hide
     def __repr__(self):
@@ -181,21 +234,78 @@ class HasSelector:
         self.ancestor_selector = ancestor_selector
         self.descendant_selector = descendant_selector
         self.priority = 15
+        self.matches = self.compile()
 
-    def ancestor_matches(self, node):
-        if self.ancestor_selector.matches(node):
-            if  not hasattr(node,'pending_css_rules'):
-                node.pending_css_rules = {}
-            
-            return True
-
-        return False
+    def compile(self):
+        # Uses the subtree summaries computed by match_has
+        def matches(node):
+            return self in getattr(node, "has_matched", NO_HAS_MATCHES)
+        return matches
 
+    def index_key(self):
+        return self.ancestor_selector.index_key()
 
     @wbetools.js_hide
     def __repr__(self):
-        return "HasSelector(selector_list={}, priority={})".format(
-            self.selector_list, self.priority)
+        return ("HasSelector(ancestor={}, descendant={}, " +
+            "priority={})").format(self.ancestor_selector,
+            self.descendant_selector, self.priority)
+
+NO_HAS_MATCHES = frozenset()
+
+def has_active(node):
+    active = []
+    ancestor = node.parent
+    while ancestor:
+        for selector in getattr(ancestor, "has_anchored", []):
+            if selector not in active:
+                active.append(selector)
+        ancestor = ancestor.parent
+    return tuple(active)
+
+def match_has(node, rules, active):
+    node.has_anchored = [selector for selector in rules.has_rules
+        if selector.ancestor_selector.matches(node)]
+    node.has_self = frozenset([selector for selector in active
+        if selector.descendant_selector.matches(node)]) or NO_HAS_MATCHES
+    child_active = active + tuple([selector
+        for selector in node.has_anchored if selector not in active])
+    below = NO_HAS_MATCHES
+    for child in node.children:
+        subtree = match_has(child, rules, child_active)
+        if subtree and not subtree <= below:
+            below = below | subtree
+    summarize_has(node, below)
+    return node.has_subtree
+
+def summarize_has(node, below):
+    node.has_matched = frozenset([selector
+        for selector in node.has_anchored if selector in below]) \
+        or NO_HAS_MATCHES
+    node.has_subtree = node.has_self | below if node.has_self else below
+
+def update_has(node, rules):
+    # Call after node or its subtree changes; returns the anchors whose
+    # :has() result changed, all of which are node or its ancestors
+    old_matched = getattr(node, "has_matched", NO_HAS_MATCHES)
+    match_has(node, rules, has_active(node))
+    changed = [node] if node.has_matched != old_matched else []
+    ancestor = node.parent
+    while ancestor:
+        old_matched = ancestor.has_matched
+        old_subtree = ancestor.has_subtree
+        below = NO_HAS_MATCHES
+        for child in ancestor.children:
+            subtree = getattr(child, "has_subtree", NO_HAS_MATCHES)
+            if subtree and not subtree <= below:
+                below = below | subtree
+        summarize_has(ancestor, below)
+        if ancestor.has_matched != old_matched:
+            changed.append(ancestor)
+        if ancestor.has_subtree == old_subtree:
+            break
+        ancestor = ancestor.parent
+    return changed
 
 def get_discrete_selector(word):
     if word.startswith("."):
@@ -208,13 +318,45 @@ class DescendantSelector:
         self.ancestor = ancestor
         self.descendant = descendant
         self.priority = ancestor.priority + descendant.priority
-            
-    def matches(self, node):
-        if not self.descendant.matches(node): return False
-        while node.parent:
-            if self.ancestor.matches(node.parent): return True
-            node = node.parent
-        return False
+        self.matches = self.compile()
+
+    def compile(self):
+        descendant = self.descendant.matches
+        # Ancestors are always Elements, so simple selectors inline
+        if isinstance(self.ancestor, TagSelector):
+            tag = self.ancestor.tag
+            def matches(node):
+                if not descendant(node): return False
+                node = node.parent
+                while node:
+                    if node.tag == tag: return True
+                    node = node.parent
+                return False
+        elif isinstance(self.ancestor, ClassSelector):
+            class_name = self.ancestor.class_name
+            def matches(node):
+                if not descendant(node): return False
+                node = node.parent
+                while node:
+                    if class_name in node_classes(node): return True
+                    node = node.parent
+                return False
+        else:
+            ancestor = self.ancestor.matches
+            def matches(node):
+                if not descendant(node): return False
+                node = node.parent
+                while node:
+                    if ancestor(node): return True
+                    node = node.parent
+                return False
+        return matches
+
+    def index_key(self):
+        return self.descendant.index_key()
+
+    def filter_keys(self):
+        return self.ancestor.filter_keys() + self.descendant.filter_keys()
 
     @wbetools.js_hide
     def __repr__(self):
@@ -228,7 +370,185 @@ INHERITED_PROPERTIES = {
     "color": "black",
 }
 
-def style(node, rules, pending_rules={}):
+def filter_slots(key):
+    h = hash(key)
+    return [h % AncestorFilter.SIZE,
+            (h >> 16) % AncestorFilter.SIZE]
+
+class AncestorFilter:
+    SIZE = 4096
+
+    def __init__(self):
+        self.counts = [0] * self.SIZE
+        self.stack = []
+        self.mismatched = 0
+        self.saved_walks = 0
+
+    def push(self, node, keys):
+        top = self.stack[-1][0] if self.stack else None
+        mismatched = node.parent is not top
+        if mismatched:
+            self.mismatched += 1
+        slots = [slot for key in keys for slot in filter_slots(key)]
+        for slot in slots:
+            self.counts[slot] += 1
+        self.stack.append((node, slots, mismatched))
+
+    def pop(self):
+        node, slots, mismatched = self.stack.pop()
+        for slot in slots:
+            self.counts[slot] -= 1
+        if mismatched:
+            self.mismatched -= 1
+
+    def usable(self, node):
+        # Only valid if the pushed nodes are exactly node's parent chain
+        top = self.stack[-1][0] if self.stack else None
+        return not self.mismatched and node.parent is top
+
+    def might_contain(self, slots):
+        for slot in slots:
+            if not self.counts[slot]:
+                return False
+        return True
+
+    @wbetools.js_hide
+    def __repr__(self):
+        return "AncestorFilter(depth={}, saved_walks={})".format(
+            len(self.stack), self.saved_walks)
+
+def compound_keys(selector):
+    if isinstance(selector, DescendantSelector):
+        return compound_keys(selector.ancestor) + \
+            compound_keys(selector.descendant)
+    return [selector.index_key()]
+
+# Node state that can change after parsing, and so needs invalidation
+DYNAMIC_KEYS = ["class", "pseudoclass"]
+
+class RuleIndex:
+    def __init__(self, rules):
+        self.rules = rules
+        self.buckets = {}
+        self.universal = []
+        self.ancestor_slots = {}
+        self.ancestors = AncestorFilter()
+        self.style_cache = {}
+        self.share_ids = {}
+        self.shared_styles = 0
+        self.subject_dependencies = set()
+        self.descendant_dependencies = {}
+        self.has_rules = []
+        for i, rule in enumerate(rules):
+            # Rules are (selector, body) or (media, selector, body)
+            selector = rule[-2]
+            if isinstance(selector, HasSelector):
+                self.has_rules.append(selector)
+            key = selector.index_key() \
+                if hasattr(selector, "index_key") else None
+            if key:
+                self.buckets.setdefault(key, []).append(i)
+            else:
+                self.universal.append(i)
+            if key and key[0] in DYNAMIC_KEYS:
+                self.subject_dependencies.add(key)
+            if isinstance(selector, DescendantSelector):
+                self.ancestor_slots[i] = [
+                    slot for key in selector.ancestor.filter_keys()
+                    for slot in filter_slots(key)]
+                for ancestor_key in compound_keys(selector.ancestor):
+                    if ancestor_key and ancestor_key[0] in DYNAMIC_KEYS:
+                        self.descendant_dependencies.setdefault(
+                            ancestor_key, set()).add(key)
+
+    def node_keys(self, node):
+        keys = [("tag", node.tag)]
+        for class_name in node_classes(node):
+            keys.append(("class", class_name))
+        return keys
+
+    def candidates(self, node):
+        indices = list(self.universal)
+        if isinstance(node, Element):
+            for key in self.node_keys(node):
+                indices.extend(self.buckets.get(key, []))
+        indices.sort()
+        if not self.ancestor_slots or not self.ancestors.usable(node):
+            return [self.rules[i] for i in indices]
+        candidates = []
+        for i in indices:
+            slots = self.ancestor_slots.get(i)
+            if slots and not self.ancestors.might_contain(slots):
+                self.ancestors.saved_walks += 1
+                continue
+            candidates.append(self.rules[i])
+        return candidates
+
+    def invalidated_nodes(self, node, keys):
+        # Nodes whose style may change when node gains or loses keys
+        nodes = []
+        if not self.subject_dependencies.isdisjoint(keys):
+            nodes.append(node)
+        subjects = set()
+        for key in keys:
+            subjects |= self.descendant_dependencies.get(key, set())
+        if not subjects: return nodes
+        for descendant in tree_to_list(node, [])[1:]:
+            if not isinstance(descendant, Element): continue
+            if None in subjects or \
+                not subjects.isdisjoint(self.node_keys(descendant)):
+                nodes.append(descendant)
+        return nodes
+
+    def push_ancestor(self, node):
+        if not self.ancestors.stack:
+            self.clear_shared_styles()
+        keys = self.node_keys(node) if isinstance(node, Element) else []
+        self.ancestors.push(node, keys)
+
+    def pop_ancestor(self):
+        self.ancestors.pop()
+        if not self.ancestors.stack:
+            self.clear_shared_styles()
+
+    def share_key(self, node):
+        # Nodes whose parents share a style have equivalent ancestors
+        parent_id = self.share_ids.get(node.parent, id(node.parent))
+        if not isinstance(node, Element):
+            return (parent_id, None)
+        return (parent_id, node.tag,
+            tuple(sorted(node.attributes.items())),
+            getattr(node, "is_focused", False))
+
+    def lookup_style(self, node):
+        key = self.share_key(node)
+        if key not in self.style_cache:
+            return key, None
+        share_id, style = self.style_cache[key]
+        self.share_ids[node] = share_id
+        self.shared_styles += 1
+        return key, style
+
+    def store_style(self, node, key, style):
+        self.style_cache[key] = (id(node), style)
+        self.share_ids[node] = id(node)
+
+    def clear_shared_styles(self):
+        self.style_cache.clear()
+        self.share_ids.clear()
+
+    @wbetools.js_hide
+    def __repr__(self):
+        return ("RuleIndex(rules={}, buckets={}, saved_walks={}, " +
+            "shared_styles={})").format(
+            len(self.rules), len(self.buckets),
+            self.ancestors.saved_walks, self.shared_styles)
+
+def style(node, rules):
+    if not isinstance(rules, RuleIndex):
+        rules = RuleIndex(rules)
+    if rules.has_rules and not rules.ancestors.stack:
+        match_has(node, rules, has_active(node))
     node.style = {}
     
     for property, default_value in INHERITED_PROPERTIES.items():
@@ -238,19 +558,13 @@ def style(node, rules, pending_rules={}):
             node.style[property] = default_value
     node.style["display"] = "inline"
     
-    for selector, body in rules:
-        if isinstance(selector, HasSelector):
-            if selector.ancestor_matches(node):
-                pending_rule = {"selector": selector.descendant_selector,
-                                "body": body,
-                                "satisfied": False}
-                node.pending_css_rules[str(id(pending_rule))] = pending_rule
-        elif selector.matches(node): 
+    for selector, body in rules.candidates(node):
+        if selector.matches(node): 
             for property, value in body.items():
                 node.style[property] = value
     
     if isinstance(node, Element) and "style" in node.attributes:
-        pairs = CSSParser(node.attributes["style"]).body()
+        pairs = parse_inline_style(node.attributes["style"])
         for property, value in pairs.items():
             node.style[property] = value
     
@@ -263,24 +577,12 @@ def style(node, rules, pending_rules={}):
         parent_px = float(parent_font_size[:-2])
         node.style["font-size"] = str(node_pct * parent_px) + "px"
 
-    for rule_id in pending_rules:
-        curr_rule = pending_rules[rule_id]
-        if not curr_rule["satisfied"] and curr_rule["selector"].matches(node):
-            curr_rule["satisfied"] = True
-    
-    if hasattr(node, "pending_css_rules"):
-        pending_rules = node.pending_css_rules | pending_rules
-
-    for child in node.children:
-        pending_rules = pending_rules | style(child, rules, pending_rules)
-
-    if hasattr(node, "pending_css_rules"):
-        for rule_id in node.pending_css_rules:
-            if pending_rules[rule_id]["satisfied"]:
-                for property, value in pending_rules[rule_id]["body"].items():
-                    node.style[property] = value
-
-    return pending_rules
+    rules.push_ancestor(node)
+    try:
+        for child in node.children:
+            style(child, rules)
+    finally:
+        rules.pop_ancestor()
 
 def cascade_priority(rule):
     selector, body = rule
@@ -306,12 +608,12 @@ class BlockLayout:
         family = node.style.get("font-family")
         font = get_font(size, weight, style, family)
 
-        w = font.measure(word)
+        w = measure_word(font, word)
         if self.cursor_x + w > self.width:
             self.flush()
         color = node.style["color"]
         self.line.append((self.cursor_x, word, font, color))
-        self.cursor_x += w + font.measure(" ")
+        self.cursor_x += w + measure_word(font, " ")
 
     def flush(self):
         if not self.line: return
@@ -10,7 +10,7 @@ import ssl
 import tkinter
 import tkinter.font
 from lab2 import WIDTH, HEIGHT, HSTEP, VSTEP, SCROLL_STEP
-from lab3 import FONTS, get_font
+from lab3 import FONTS, get_font, measure_word
 from lab4 import Text, Element, print_tree, HTMLParser
 from lab5 import BLOCK_ELEMENTS, DocumentLayout, paint_tree
 from lab6 import CSSParser, TagSelector, DescendantSelector
@@ -93,10 +93,10 @@ class TextLayout:
         self.font = get_font(size, weight, style)
 
         # Do not set self.y!!!
-        self.width = self.font.measure(self.word)
+        self.width = measure_word(self.font, self.word)
 
         if self.previous:
-            space = self.previous.font.measure(" ")
+            space = measure_word(self.previous.font, " ")
             self.x = self.previous.x + space + self.previous.width
         else:
             self.x = self.parent.x
@@ -169,14 +169,14 @@ class BlockLayout:
         size = int(float(node.style["font-size"][:-2]) * .75)
         font = get_font(size, weight, style)
 
-        w = font.measure(word)
+        w = measure_word(font, word)
         if self.cursor_x + w > self.width:
             self.new_line()
         line = self.children[-1]
         previous_word = line.children[-1] if line.children else None
         text = TextLayout(node, word, line, previous_word)
         line.children.append(text)
-        self.cursor_x += w + font.measure(" ")
+        self.cursor_x += w + measure_word(font, " ")
 
     def self_rect(self):
         return Rect(self.x, self.y,
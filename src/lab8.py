@@ -11,7 +11,7 @@ import tkinter
 import tkinter.font
 import urllib.parse
 from lab2 import WIDTH, HEIGHT, HSTEP, VSTEP, SCROLL_STEP
-from lab3 import FONTS, get_font
+from lab3 import FONTS, get_font, measure_word
 from lab4 import Text, Element, print_tree, HTMLParser
 from lab5 import BLOCK_ELEMENTS, DocumentLayout
 from lab6 import CSSParser, TagSelector, DescendantSelector
@@ -106,7 +106,7 @@ class InputLayout:
         self.width = INPUT_WIDTH_PX
 
         if self.previous:
-            space = self.previous.font.measure(" ")
+            space = measure_word(self.previous.font, " ")
             self.x = self.previous.x + space + self.previous.width
         else:
             self.x = self.parent.x
@@ -214,7 +214,7 @@ class BlockLayout:
         size = int(float(node.style["font-size"][:-2]) * .75)
         font = get_font(size, weight, style)
 
-        self.cursor_x += w + font.measure(" ")
+        self.cursor_x += w + measure_word(font, " ")
 
     def should_paint(self):
         return isinstance(self.node, Text) or \
@@ -279,6 +279,12 @@ class MockFont:
     def measureText(self, word):
         return self.size * len(word)
 
+    def textToGlyphs(self, text):
+        return [ord(c) for c in text]
+
+    def getWidths(self, glyphs):
+        return [self.size for glyph in glyphs]
+
     def getMetrics(self, name=None):
         m = skia.FontMetrics()
         m.fAscent = -self.size * .75
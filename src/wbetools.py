@@ -76,13 +76,17 @@ FORCE_CROSS_ORIGIN_IFRAMES = False
 ASSERT_LAYOUT_CLEAN = False
 PRINT_INVALIDATION_DEPENDENCIES = False
 OUTPUT_TRACE = False
+LAZY_LAYOUT = False
+PERSIST_WORD_WIDTHS = False
+PERSIST_STYLESHEETS = False
 
 def parse_flags():
     import argparse, sys
     global SHOW_COMPOSITED_LAYER_BORDERS, \
         USE_COMPOSITING, USE_GPU, USE_BROWSER_THREAD, \
         FORCE_CROSS_ORIGIN_IFRAMES, ASSERT_LAYOUT_CLEAN, \
-        PRINT_INVALIDATION_DEPENDENCIES, OUTPUT_TRACE
+        PRINT_INVALIDATION_DEPENDENCIES, OUTPUT_TRACE, LAZY_LAYOUT, \
+        PERSIST_WORD_WIDTHS, PERSIST_STYLESHEETS
 
     parser = argparse.ArgumentParser(description='Chapter 13 code')
     parser.add_argument("url", type=str, help="URL to load")
@@ -102,6 +106,12 @@ def parse_flags():
         default=False, help="Whether to print out all invalidation dependencies")
     parser.add_argument("--trace", action="store_true",
         default=False, help="Whether to output a browser.trace file")
+    parser.add_argument("--lazy_layout", action="store_true",
+        default=False, help="Whether to skip layout of offscreen blocks")
+    parser.add_argument("--persist_word_widths", action="store_true",
+        default=False, help="Whether to save measured word widths to disk")
+    parser.add_argument("--persist_stylesheets", action="store_true",
+        default=False, help="Whether to save parsed stylesheets to disk")
     args = parser.parse_args()
 
     USE_BROWSER_THREAD = not args.single_threaded
@@ -112,5 +122,8 @@ def parse_flags():
     ASSERT_LAYOUT_CLEAN = args.assert_layout_clean
     PRINT_INVALIDATION_DEPENDENCIES = args.print_invalidation_dependencies
     OUTPUT_TRACE = args.trace
+    LAZY_LAYOUT = args.lazy_layout
+    PERSIST_WORD_WIDTHS = args.persist_word_widths
+    PERSIST_STYLESHEETS = args.persist_stylesheets
 
     sys.argv = [sys.argv[0], args.url]